@@ -0,0 +1,223 @@
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from metadatacache import MetadataCache
+from optimizer import Optimizer
+from pngImage import Png
+from renderer import render
+
+log = logging.getLogger(__name__)
+
+def expand_paths(paths):
+    """Turn directories and glob patterns into paths of PNG files
+
+    Directories are searched recursively for *.png files. Glob patterns may use '**'.
+    Every file is returned only once, in order of appearance.
+
+    Args:
+        paths(iterable): Paths of files or directories, or glob patterns
+
+    Returns:
+        list: Paths of files
+    """
+    file_names = {}
+    for path in paths:
+        path = str(path)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.png'):
+                        file_names[os.path.join(root, name)] = None
+        elif glob.has_magic(path):
+            for file_name in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(file_name):
+                    file_names[file_name] = None
+        else:
+            file_names[path] = None
+    return list(file_names)
+
+def get_output_file_name(file_name, options):
+    if options.get('in_place'):
+        return file_name
+    assert options.get('output_dir'), "Either output_dir or in_place must be set"
+    return os.path.join(options['output_dir'], os.path.basename(file_name))
+
+def metadata_file(png, options):
+    ihdr_chunk = png.get_chunk_by_type(b'IHDR')
+    chunks = []
+    for chunk, computed_crc, is_valid in png.verify_crc(1):
+        chunks.append({**chunk.get_record(), 'crc_valid': is_valid})
+    return {
+        'width': ihdr_chunk.width,
+        'height': ihdr_chunk.height,
+        'bit_depth': ihdr_chunk.bit_depth,
+        'color_type': ihdr_chunk.color_type,
+        'interlace_method': ihdr_chunk.interlace_method,
+        'chunks': chunks,
+        'after_iend_data_len': len(png.after_iend_data),
+    }
+
+def verify_file(png, options):
+    corrupted = [{'type': chunk.type_.decode('utf-8', 'replace'), 'offset': chunk.offset, 'crc': chunk.crc.hex(),
+                    'computed_crc': f"{computed_crc:08x}"} for chunk, computed_crc, is_valid in png.verify_crc(1) if not is_valid]
+    return {'valid': not corrupted, 'corrupted_chunks': corrupted}
+
+def clean_file(png, options):
+    new_file_name = get_output_file_name(png.file.name, options)
+    png.create_clean_copy(new_file_name)
+    return {'output_file': new_file_name, 'size': os.path.getsize(new_file_name)}
+
+def optimize_file(png, options):
+    new_file_name = get_output_file_name(png.file.name, options)
+    # Files are already processed in parallel, so trials of single file are not
+    optimizer = Optimizer(png, options['filters'], options['levels'], options['strategies'], options['mem_levels'], workers=1)
+    results = optimizer.run()
+    best_trial, best_len, _ = min(results, key=lambda result: result[1])
+    optimizer.write(new_file_name, options.get('strip', False))
+    return {'output_file': new_file_name, 'original_idat_len': optimizer.get_original_idat_data_len(),
+            'best_idat_len': best_len, 'best_trial': list(best_trial)}
+
+def render_file(png, options):
+    new_file_name = get_output_file_name(png.file.name, options)
+    width, height = render(png, new_file_name, options.get('size'), options.get('keep_alpha', False), options.get('background'))
+    return {'output_file': new_file_name, 'width': width, 'height': height}
+
+"""Points batch operation name to function, which takes parsed Png and options and returns JSON-serializable dict
+"""
+OPERATIONS = {
+    'metadata': metadata_file,
+    'verify': verify_file,
+    'clean': clean_file,
+    'optimize': optimize_file,
+    'render': render_file,
+}
+
+# Operations whose results depend only on file content, so they can be stored in MetadataCache
+CACHED_OPERATIONS = ('metadata',)
+
+# Every worker process opens the cache only once
+_metadata_cache = None
+
+def get_metadata_cache(operation, options):
+    """Return MetadataCache of current process, or None if operation results should not be cached
+    """
+    global _metadata_cache
+    if operation not in CACHED_OPERATIONS or not options.get('cache', True):
+        return None
+    if _metadata_cache is None:
+        _metadata_cache = MetadataCache(options.get('cache_path'))
+    return _metadata_cache
+
+def get_record(operation, file_name, options, cache=None):
+    """Run operation on file or, if cache has valid entry of file, return cached result
+
+    Args:
+        operation(str): One of OPERATIONS
+        file_name(str): Path of PNG file
+        options(dict): Options of operation
+        cache(MetadataCache): Optional. Cache of CACHED_OPERATIONS results - see get_metadata_cache.
+
+    Returns:
+        tuple: (record, cached) - result of operation and flag, whether it has been taken from cache
+    """
+    if cache:
+        key = cache.get_key(file_name)
+        record = cache.get(key)
+        if record is not None:
+            return record, True
+    png = Png(file_name)
+    png.parse(True)
+    record = OPERATIONS[operation](png, options)
+    if cache:
+        cache.put(key, record)
+    return record, False
+
+def process_files(operation, file_names, options):
+    """Run operation on every file. It is executed in a worker process.
+
+    Every file is handled separately, so broken file does not stop processing of the others.
+
+    Returns:
+        list: One result dict per file
+    """
+    cache = get_metadata_cache(operation, options)
+    results = []
+    for file_name in file_names:
+        start_time = time.perf_counter()
+        result = {'file': file_name, 'operation': operation}
+        try:
+            record, cached = get_record(operation, file_name, options, cache)
+            if cache:
+                result['cached'] = cached
+            result.update(record)
+            result['ok'] = True
+        except Exception as e:
+            result['ok'] = False
+            result['error'] = f"{type(e).__name__}: {e}"
+        result['elapsed'] = round(time.perf_counter() - start_time, 6)
+        results.append(result)
+    return results
+
+def run_batch(operation, file_names, options=None, workers=None, chunk_size=64):
+    """Run operation on many files in a process pool
+
+    Files are submitted in chunks of chunk_size files, so a pool task is not created for every single file.
+    Only a few chunks per worker are in flight at once, so memory usage does not depend on the number of files.
+
+    Args:
+        operation(str): One of OPERATIONS
+        file_names(list): Paths of PNG files
+        options(dict): Options of operation, e.g. output_dir. Metadata cache is controlled by 'cache' (defaults to true),
+                       'cache_path' and 'cache_size' (see MetadataCache) options.
+        workers(int): Number of processes. Defaults to ProcessPoolExecutor default.
+        chunk_size(int): Number of files processed by single pool task
+
+    Yields:
+        dict: Result of every file, in order of completion. It always contains 'file', 'ok' and 'elapsed' keys,
+              and 'error' key if file could not be processed. Results of CACHED_OPERATIONS contain 'cached' key,
+              unless options['cache'] is false.
+    """
+    assert operation in OPERATIONS, f"Unknown batch operation: {operation}. It must be one of: {list(OPERATIONS)}"
+    options = options or {}
+    chunks = (file_names[i : i + chunk_size] for i in range(0, len(file_names), chunk_size))
+
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = 2 * workers
+    with ProcessPoolExecutor(workers) as executor:
+        in_flight = set()
+        for chunk in chunks:
+            in_flight.add(executor.submit(process_files, operation, chunk, options))
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in as_completed(in_flight):
+            yield from future.result()
+
+    if operation in CACHED_OPERATIONS and options.get('cache', True):
+        cache = MetadataCache(options.get('cache_path'), options.get('cache_size', MetadataCache.DEFAULT_MAX_ENTRIES))
+        cache.evict()
+        cache.close()
+
+def write_ndjson(results, output, total, progress=True):
+    """Write every result as a single JSON line and report progress on stderr
+
+    Returns:
+        int: Number of files that failed - could not be processed or (verify) have corrupted chunks
+    """
+    failed = 0
+    for done, result in enumerate(results, 1):
+        failed += not result['ok'] or result.get('valid') is False
+        output.write(json.dumps(result) + '\n')
+        if progress:
+            sys.stderr.write(f"\r[{done}/{total}] files processed, {failed} failed")
+            sys.stderr.flush()
+    if progress and total:
+        sys.stderr.write('\n')
+    output.flush()
+    return failed
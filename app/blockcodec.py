@@ -0,0 +1,77 @@
+from lazyimport import lazy_import
+
+np = lazy_import('numpy')
+
+class BlockCodec:
+    """Layout of RSA blocks in encrypted PNG
+
+    Every encrypted block has block_len bytes, but only payload_len of them replace original pixels. Payloads of all
+    blocks (and the overflow byte of the last block) form cipher data, which is written as pixels (IDAT) and - if it is
+    longer than original pixels - after IEND chunk. Overflow bytes (the last byte of every other block) are written
+    after IEND chunk too.
+
+    Buffer of blocks is viewed as (blocks, block_len) array, so payloads and overflow bytes are two strided views of it
+    and nothing is moved byte by byte.
+
+    Args:
+        block_len(int): Length of encrypted block
+        payload_len(int): Length of block's part which goes to cipher data
+    """
+    def __init__(self, block_len, payload_len):
+        self.block_len = block_len
+        self.payload_len = payload_len
+
+    def get_blocks_view(self, blocks):
+        """Return (blocks, block_len) uint8 array viewing buffer of encrypted blocks
+        """
+        return np.frombuffer(blocks, dtype=np.uint8).reshape(-1, self.block_len)
+
+    def split(self, blocks):
+        """Split buffer of encrypted blocks into cipher data and overflow bytes of all blocks but the last one
+
+        Args:
+            blocks: Bytes-like object with encrypted blocks, one after another
+
+        Returns:
+            tuple: (cipher_data, after_iend_data_embedded) - contiguous uint8 arrays. after_iend_data_embedded is a view of blocks.
+        """
+        view = self.get_blocks_view(blocks)
+        payload, overflow = view[:, :self.payload_len], view[:, -1]
+        cipher_data = np.empty(payload.size + 1, dtype=np.uint8)
+        cipher_data[:-1].reshape(payload.shape)[:] = payload
+        cipher_data[-1:] = overflow[-1:]
+        # Strided column is compacted, so it can be written to a file as it is
+        return cipher_data, np.ascontiguousarray(overflow[:-1])
+
+    def join(self, data, after_iend_data):
+        """Merge pixels read from encrypted PNG and data stored after its IEND chunk back into buffer of encrypted blocks
+
+        Every payload_len bytes of data are followed by the next byte of after_iend_data. Remaining after_iend_data goes at the end.
+
+        Args:
+            data: Bytes-like object with pixels
+            after_iend_data: Bytes-like object with data stored after IEND chunk
+
+        Returns:
+            bytearray: Encrypted blocks, one after another
+        """
+        data = np.frombuffer(memoryview(data).cast('B'), dtype=np.uint8)
+        after_iend_data = np.frombuffer(memoryview(after_iend_data).cast('B'), dtype=np.uint8)
+        blocks = bytearray(len(data) + len(after_iend_data))
+        view = np.frombuffer(blocks, dtype=np.uint8)
+
+        full_blocks = len(data) // self.payload_len
+        full_blocks_view = view[:full_blocks * (self.payload_len + 1)].reshape(full_blocks, self.payload_len + 1)
+        full_blocks_view[:, :-1] = data[:full_blocks * self.payload_len].reshape(full_blocks, self.payload_len)
+        full_blocks_view[:, -1] = after_iend_data[:full_blocks]
+
+        position = full_blocks * (self.payload_len + 1)
+        used_after_iend_data = full_blocks
+        remainder = data[full_blocks * self.payload_len:]
+        if len(remainder):
+            view[position : position + len(remainder)] = remainder
+            view[position + len(remainder)] = after_iend_data[full_blocks]
+            position += len(remainder) + 1
+            used_after_iend_data += 1
+        view[position:] = after_iend_data[used_after_iend_data:]
+        return blocks
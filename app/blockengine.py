@@ -0,0 +1,125 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+log = logging.getLogger(__name__)
+
+def rsa_pow(value, key):
+    """Raise value to the power of key's exponent modulo key's modulus
+
+    Key is either (exponent, modulus) or private key (d, n, p, q, dP, dQ, qInv). For the latter, Chinese Remainder Theorem
+    is used: value is exponentiated modulo p and modulo q (with half-size exponents) and results are recombined
+    with Garner's formula. It is about 3-4 times faster than the full-size exponentiation and gives the same result.
+
+    Args:
+        value(int): Number smaller than modulus
+        key(tuple): (exponent, modulus) or (d, n, p, q, dP, dQ, qInv)
+    """
+    if len(key) == 2:
+        return pow(value, key[0], key[1])
+    _, _, p, q, dP, dQ, qInv = key
+    m1 = pow(value, dP, p)
+    m2 = pow(value, dQ, q)
+    h = qInv * (m1 - m2) % p
+    return m2 + h * q
+
+def pow_blocks(input_buffer, output_buffer, first_block, last_block, input_block_len, output_block_len, last_output_block_len, key):
+    """Exponentiate every block of input buffer with rsa_pow and write results to output buffer
+
+    Block i is read from input_buffer[i * input_block_len : (i + 1) * input_block_len] (the last block of input
+    may be shorter) and written (big-endian) to output_buffer[i * output_block_len : ...]. The last block of output
+    has last_output_block_len bytes.
+
+    Args:
+        input_buffer: Buffer with all input blocks
+        output_buffer: Writable buffer for all output blocks
+        first_block(int): Index of the first processed block
+        last_block(int): Index of the last processed block + 1
+        input_block_len(int): Length of input block
+        output_block_len(int): Length of output block
+        last_output_block_len(int): Length of the very last output block (of the whole buffer, not only of processed range)
+        key(tuple): RSA key - see rsa_pow
+    """
+    blocks_number = -(-len(input_buffer) // input_block_len)
+    for i in range(first_block, last_block):
+        block = input_buffer[i * input_block_len : (i + 1) * input_block_len]
+        result_len = last_output_block_len if i == blocks_number - 1 else output_block_len
+        result = rsa_pow(int.from_bytes(block, 'big'), key).to_bytes(result_len, 'big')
+        output_buffer[i * output_block_len : i * output_block_len + result_len] = result
+
+def pow_shared_blocks(input_name, input_len, output_name, output_len, *args):
+    """Run pow_blocks on shared memory buffers. It is executed in a worker process.
+    """
+    input_memory = shared_memory.SharedMemory(input_name)
+    output_memory = shared_memory.SharedMemory(output_name)
+    try:
+        pow_blocks(input_memory.buf[:input_len], output_memory.buf[:output_len], *args)
+    finally:
+        input_memory.close()
+        output_memory.close()
+
+class BlockEngine:
+    """Modular exponentiation of independent blocks (e.g. RSA in ECB mode) split across a process pool
+
+    Blocks are divided into contiguous ranges, several per worker, so that workers finishing early can take the next range.
+    Input and output buffers are passed through shared memory - workers read theirs blocks and write results directly to
+    theirs offsets of the output buffer, so output does not depend on the order in which ranges are finished.
+    Result is byte-identical to the serial computation.
+
+    Args:
+        workers(int): Number of processes. Defaults to number of CPUs. With 1 blocks are processed serially in current process.
+    """
+    # Number of block ranges per worker
+    RANGES_PER_WORKER = 4
+    # Below this number of blocks, starting processes costs more than it saves
+    MIN_PARALLEL_BLOCKS = 64
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+
+    def pow(self, data, input_block_len, output_block_len, key, last_output_block_len=None):
+        """Split data into blocks of input_block_len bytes and exponentiate each of them with rsa_pow
+
+        Args:
+            data: Bytes-like object
+            input_block_len(int): Length of input block. The last block may be shorter.
+            output_block_len(int): Length of output block
+            key(tuple): RSA key - see rsa_pow
+            last_output_block_len(int): Length of the last output block. Defaults to output_block_len.
+
+        Returns:
+            bytearray: Output blocks, one after another
+        """
+        data = memoryview(data).cast('B')
+        blocks_number = -(-len(data) // input_block_len)
+        if last_output_block_len is None:
+            last_output_block_len = output_block_len
+        output_len = max(0, (blocks_number - 1) * output_block_len + last_output_block_len)
+        block_args = (input_block_len, output_block_len, last_output_block_len, key)
+
+        if self.workers == 1 or blocks_number < self.MIN_PARALLEL_BLOCKS:
+            output = bytearray(output_len)
+            pow_blocks(data, output, 0, blocks_number, *block_args)
+            return output
+
+        ranges_number = min(blocks_number, self.workers * self.RANGES_PER_WORKER)
+        bounds = [blocks_number * i // ranges_number for i in range(ranges_number + 1)]
+        log.debug(f"Processing {blocks_number} blocks in {ranges_number} ranges by {self.workers} processes")
+
+        input_memory = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        output_memory = shared_memory.SharedMemory(create=True, size=max(1, output_len))
+        try:
+            input_memory.buf[:len(data)] = data
+            with ProcessPoolExecutor(self.workers) as executor:
+                futures = [executor.submit(pow_shared_blocks, input_memory.name, len(data), output_memory.name, output_len,
+                                            first_block, last_block, *block_args)
+                            for first_block, last_block in zip(bounds, bounds[1:])]
+                for future in futures:
+                    future.result()
+            return bytearray(output_memory.buf[:output_len])
+        finally:
+            input_memory.close()
+            input_memory.unlink()
+            output_memory.close()
+            output_memory.unlink()
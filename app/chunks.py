@@ -1,76 +1,164 @@
+import io
+import json
 import struct
 import logging
-import traceback
-from itertools import zip_longest
-from contextlib import contextmanager
+import zlib
 import calendar
+from lazyimport import lazy_import
 
-try:
-    from tabulate import tabulate
-except ModuleNotFoundError:
-    traceback.print_exc()
-    print("\033[1;33mBefore you will debug, please delete 'venv' dir from project root and try again.\033[0m")
-    exit(1)
+np = lazy_import('numpy')
+tabulate = lazy_import('tabulate')
 
 log = logging.getLogger(__name__)
 
-@contextmanager
-def temporary_data_change(object_to_change, tmp_data):
-    """It is used to temporarly switch 'data' attribute of chunks.
-
-    Every chunk inherits __str__ method of base Chunk class. Thanks to that, command line prinitng
-    is consistent, fairly simple and every chunk is printed IN THE SAME WAY. Nevertheless, chunks contain different information in theirs data field.
-    Thats why sometimes we would like to print it in an individual manner.
-
-    Thanks to this function, chunks can temporarly change their data field when executing their own overloaded __str__ method.
-
-    Args:
-        object_to_change: This must be a Chunk-based object whose data will be switched
-        tmp_data: Data to be switched
-    """
-    original_data = getattr(object_to_change, 'data')
-    setattr(object_to_change, 'data', tmp_data)
-    try:
-        yield
-    finally:
-        setattr(object_to_change, 'data', original_data)
-
 class Chunk:
     """Base representation of PNG's chunk
 
     Setup the attributes and define printing standard.
+
+    Data field can be either bytes or memoryview, so it should not be treated as 'bytes' object.
+
+    Every subclass defines __slots__ (with its own decoded attributes only), so chunk objects have no per-instance __dict__.
+    Values decoded lazily are memoized in slots initialized with None.
     """
+    __slots__ = ('length', 'type_', 'data', 'crc', 'offset')
+
     # Constants below indicates how many bytes to read from a file. Data field is not included because it's not a constant.
     # DATA_FIELD_LEN is a value of self.length.
     LENGTH_FIELD_LEN = 4
     TYPE_FIELD_LEN = 4
     CRC_FIELD_LEN = 4
+    # Number of data bytes formatted at once when data is dumped as hex
+    HEX_DUMP_BLOCK_LEN = 2 ** 16
+    # Names of decoded attributes returned by get_fields
+    FIELDS = ()
 
-    def __init__(self, length, type_, data, crc):
+    def __init__(self, length, type_, data, crc, offset=None):
         log.debug(f"Creating {type_.decode('utf-8')} chunk")
         self.length = length
         self.type_ = type_
+        # Usually it is a memoryview slice of memory-mapped file, so chunk's data is not copied until it is really used
         self.data = data
         self.crc = crc
+        # Position of chunk (its length field) in the file. It is None for chunks that were not read from a file.
+        self.offset = offset
+
+    def write(self, file_handler):
+        """Write all fields of chunk to binary file
+        """
+        file_handler.write(self.length)
+        file_handler.write(self.type_)
+        file_handler.write(self.data)
+        file_handler.write(self.crc)
+
+    def compute_crc(self):
+        """Compute CRC-32 of chunk's type and data fields
+
+        zlib releases GIL while computing CRC of big buffers, so chunks can be verified by many threads at once.
+        """
+        return zlib.crc32(self.data, zlib.crc32(self.type_))
+
+    def is_crc_valid(self):
+        return self.compute_crc() == int.from_bytes(self.crc, 'big')
 
     def __str__(self):
-        try:
-            if b'Xt' in self.type_:
-                # Bytes containing text data. We check if chunk type matches one of text-containing chunks -> iTXt tEXt zTXt
-                data = self.data.decode('utf-8')
+        output = io.StringIO()
+        self.write_description(output)
+        return output.getvalue()
+
+    def get_data_description(self):
+        """Return human-readable representation of data field, or None if data should be dumped as hex
+
+        Subclasses override it to describe theirs decoded fields.
+        """
+        if b'Xt' in self.type_:
+            # Bytes containing text data. We check if chunk type matches one of text-containing chunks -> iTXt tEXt zTXt
+            return str(self.data, 'utf-8', 'replace')
+        return None
+
+    def write_description(self, output, with_data=True):
+        """Write chunk in human-readable form to text stream
+
+        Hex dump of data is written block by block, so even huge IDAT chunk is never formatted as a single string.
+
+        Args:
+            output: Text stream, e.g. sys.stdout
+            with_data(bool): If set to false, data field is left empty
+        """
+        output.write(f"Length: {int.from_bytes(self.length, 'big')}\nType: {self.type_.decode('utf-8')}\nData: ")
+        if with_data:
+            data_description = self.get_data_description()
+            if data_description is None:
+                self.write_hex_data(output)
             else:
-                # Bytes containing hex data
-                data = ' '.join(str(byte) for byte in self.data.hex(' ').split())
-        except:
-            # Some other __str__ method has manipulated the self.data and we want to leave it as it is
-            data = self.data
+                output.write(str(data_description))
+        output.write(f"\nCRC: {self.crc.hex(' ')}\n")
+
+    def write_hex_data(self, output):
+        """Write data field as space-separated hex bytes, HEX_DUMP_BLOCK_LEN bytes at a time
+        """
+        data = memoryview(self.data)
+        for i in range(0, len(data), self.HEX_DUMP_BLOCK_LEN):
+            if i:
+                output.write(' ')
+            output.write(data[i : i + self.HEX_DUMP_BLOCK_LEN].hex(' '))
+
+    def get_fields(self):
+        """Return decoded fields of chunk as JSON-serializable dict
+
+        Subclasses list names of theirs decoded attributes in FIELDS.
+        """
+        fields = {field: getattr(self, field) for field in self.FIELDS}
+        if b'Xt' in self.type_:
+            fields['text'] = str(self.data, 'utf-8', 'replace')
+        return fields
+
+    def get_record(self):
+        """Return JSON-serializable dict with common fields of chunk and its decoded fields (see get_fields)
+        """
+        return {
+            'type': self.type_.decode('utf-8', 'replace'),
+            'length': int.from_bytes(self.length, 'big'),
+            'offset': self.offset,
+            'crc': self.crc.hex(),
+            **self.get_fields(),
+        }
+
+    def write_json(self, output, with_data=False):
+        """Write chunk's record (see get_record) as a single JSON object to text stream
+
+        Args:
+            output: Text stream, e.g. sys.stdout
+            with_data(bool): If set to true, raw data is added as 'data' hex string. It is written block by block.
+        """
+        self.write_record_json(output, self.get_record(), self.data if with_data else None)
+
+    @classmethod
+    def write_record_json(cls, output, record, data=None):
+        """Write chunk's record as a single JSON object to text stream, with raw data as 'data' hex string, if it is given
 
-        return (f"Length: {int.from_bytes(self.length, 'big')}\nType: {self.type_.decode('utf-8')}\n"
-                    f"Data: {data}\nCRC: {self.crc.hex(' ')}\n")
+        Args:
+            output: Text stream, e.g. sys.stdout
+            record(dict): Chunk's record - see get_record
+            data: Optional. Bytes-like object. It is written block by block.
+        """
+        record = json.dumps(record)
+        if data is None:
+            output.write(record)
+            return
+        # Hex digits never need escaping, so data is streamed straight into JSON string
+        output.write(record[:-1] + ', "data": "')
+        data = memoryview(data)
+        for i in range(0, len(data), cls.HEX_DUMP_BLOCK_LEN):
+            output.write(data[i : i + cls.HEX_DUMP_BLOCK_LEN].hex())
+        output.write('"}')
 
 class IHDR(Chunk):
-    def __init__(self, length, type_, data, crc):
-        super().__init__(length, type_, data, crc)
+    __slots__ = ('width', 'height', 'bit_depth', 'color_type', 'compression_method', 'filter_method', 'interlace_method')
+    FIELDS = ('width', 'height', 'bit_depth', 'color_type', 'compression_method', 'filter_method', 'interlace_method')
+
+    def __init__(self, length, type_, data, crc, offset=None):
+        super().__init__(length, type_, data, crc, offset)
 
         values = struct.unpack('>iibbbbb', self.data)
         self.width = values[0]
@@ -81,50 +169,93 @@ class IHDR(Chunk):
         self.filter_method = values[5]
         self.interlace_method = values[6]
 
-    def __str__(self):
-        data = (f"Width: {self.width} | Height: {self.height} | BitDepth: {self.bit_depth} | ColorType: {self.color_type} | "
-                            f"CompressionMethod: {self.compression_method} | FilterMethod: {self.filter_method} | InterlaceMethod {self.interlace_method}")
-        with temporary_data_change(self, data):
-            return super().__str__()
+    def get_data_description(self):
+        return (f"Width: {self.width} | Height: {self.height} | BitDepth: {self.bit_depth} | ColorType: {self.color_type} | "
+                    f"CompressionMethod: {self.compression_method} | FilterMethod: {self.filter_method} | InterlaceMethod {self.interlace_method}")
 
 class PLTE(Chunk):
-    def __init__(self, length, type_, data, crc):
-        super().__init__(length, type_, data, crc)
+    __slots__ = ('pallette_array', 'parsed_data')
 
-    def __str__(self):
-        if self.data:
-            # Data is not empty. That means that user have used the --plte flag and data should be printed in a decoded manner
-            data = self.get_parsed_data()
-        else:
-            # Default behavior -> data is skipped, because often it is too long
-            data = self.data
-        with temporary_data_change(self, data):
-            return super().__str__()
+    def __init__(self, length, type_, data, crc, offset=None):
+        super().__init__(length, type_, data, crc, offset)
+        self.pallette_array = None
+        self.parsed_data = None
+
+    def get_data_description(self):
+        return self.get_parsed_data()
+
+    def get_fields(self):
+        return {'entries': self.get_entries_count()}
+
+    def get_entries_count(self):
+        return len(self.data) // 3
 
     def get_parsed_data(self):
         """Decode 'data' field of PLTE chunk and return it as a list of RGB pixel tuples
+
+        Samples are read straight from data buffer with strided memoryview slices. List is created during the first call and cached afterwards.
         """
-        decoded_pixels = iter([int(byte, 16) for byte in self.data.hex(' ').split()])
+        if self.parsed_data is None:
+            data = memoryview(self.data)[:self.get_entries_count() * 3]
+            self.parsed_data = list(zip(data[0::3], data[1::3], data[2::3]))
+        return self.parsed_data
 
-        # zip_longest pack pixel chunks into 3-element RGB tuples using unpacked iterator
-        return [pixel_tuple for pixel_tuple in zip_longest(*[decoded_pixels]*3)]
+    def get_pallette_array(self):
+        """Return pallette as uint8 array of shape (entries, 3), which can be used as a look-up table
+
+        Array is read directly from data buffer during the first call and cached afterwards.
+        """
+        if self.pallette_array is None:
+            self.pallette_array = np.frombuffer(self.data, dtype=np.uint8).reshape(-1, 3)
+        return self.pallette_array
 
 class IDAT(Chunk):
-    def __init__(self, length, type_, data, crc):
-        super().__init__(length, type_, data, crc)
+    __slots__ = ()
+
+    def __init__(self, length, type_, data, crc, offset=None):
+        super().__init__(length, type_, data, crc, offset)
+
+class tRNS(Chunk):
+    __slots__ = ('pallette_alpha',)
+
+    def __init__(self, length, type_, data, crc, offset=None):
+        super().__init__(length, type_, data, crc, offset)
+        self.pallette_alpha = None
+
+    def get_pallette_alpha(self, entries):
+        """Return alpha values for every pallette entry (used with color type 3)
+
+        tRNS chunk may contain fewer values than there are entries in pallette. Remaining entries are fully opaque.
+
+        Args:
+            entries(int): Number of pallette entries
+
+        Returns:
+            np.ndarray: Read-only uint8 array of length entries. It is cached, so the same array is returned for the same number of entries.
+        """
+        if self.pallette_alpha is None or len(self.pallette_alpha) != entries:
+            alpha = np.full(entries, 255, dtype=np.uint8)
+            alpha[:len(self.data)] = np.frombuffer(self.data, dtype=np.uint8)
+            alpha.flags.writeable = False
+            self.pallette_alpha = alpha
+        return self.pallette_alpha
 
 class IEND(Chunk):
-    def __init__(self, length, type_, data, crc):
-        super().__init__(length, type_, data, crc)
+    __slots__ = ()
 
-    def __str__(self):
-        with temporary_data_change(self, "\'\'"):
-            # Explicitly print quotes to emphasise that data field is empty. If we would simply use str.decode('utf-8'), quotes wouldn't appear.
-            return super().__str__()
+    def __init__(self, length, type_, data, crc, offset=None):
+        super().__init__(length, type_, data, crc, offset)
+
+    def get_data_description(self):
+        # Explicitly print quotes to emphasise that data field is empty. If we would simply use str.decode('utf-8'), quotes wouldn't appear.
+        return "\'\'"
 
 class tIME(Chunk):
-    def __init__(self, length, type_, data, crc):
-        super().__init__(length, type_, data, crc)
+    __slots__ = ('year', 'month', 'day', 'hour', 'minute', 'second')
+    FIELDS = ('year', 'month', 'day', 'hour', 'minute', 'second')
+
+    def __init__(self, length, type_, data, crc, offset=None):
+        super().__init__(length, type_, data, crc, offset)
 
         values = struct.unpack('>hbbbbb', self.data)
         self.year = values[0]
@@ -134,27 +265,30 @@ class tIME(Chunk):
         self.minute = values[4]
         self.second = values[5]
 
-    def __str__(self):
-        data = f"Last modification: {self.day} {calendar.month_abbr[self.month]}. {self.year} {self.hour}:{self.minute}:{self.second}"
-        with temporary_data_change(self, data):
-            return super().__str__()
+    def get_data_description(self):
+        return f"Last modification: {self.day} {calendar.month_abbr[self.month]}. {self.year} {self.hour}:{self.minute}:{self.second}"
 
 class gAMA(Chunk):
-    def __init__(self, length, type_, data, crc):
-        super().__init__(length, type_, data, crc)
+    __slots__ = ('gamma',)
+    FIELDS = ('gamma',)
+
+    def __init__(self, length, type_, data, crc, offset=None):
+        super().__init__(length, type_, data, crc, offset)
 
         # PNG specification says, that stored gamma value is multiplied by 100000
         self.gamma = int.from_bytes(data, 'big') / 100000
         if self.gamma == 0:
             log.warning("Gamma shouldn't have value 0!")
 
-    def __str__(self):
-        with temporary_data_change(self, self.gamma):
-            return super().__str__()
+    def get_data_description(self):
+        return self.gamma
 
 class cHRM(Chunk):
-    def __init__(self, length, type_, data, crc):
-        super().__init__(length, type_, data, crc)
+    __slots__ = ('WPx', 'WPy', 'WPz', 'Rx', 'Ry', 'Rz', 'Gx', 'Gy', 'Gz', 'Bx', 'By', 'Bz')
+    FIELDS = ('WPx', 'WPy', 'Rx', 'Ry', 'Gx', 'Gy', 'Bx', 'By')
+
+    def __init__(self, length, type_, data, crc, offset=None):
+        super().__init__(length, type_, data, crc, offset)
 
         values = struct.unpack('>iiiiiiii', self.data)
         # PNG specification says, that stored values are multiplied by 100000
@@ -171,15 +305,14 @@ class cHRM(Chunk):
         self.By = values[7] / 100000
         self.Bz = 1 - self.Bx - self.By
 
-    def __str__(self):
-        table = tabulate([['x', self.Rx, self.Gx, self.Bx, self.WPx],
+    def get_data_description(self):
+        table = tabulate.tabulate([['x', self.Rx, self.Gx, self.Bx, self.WPx],
                           ['y', self.Ry, self.Gy, self.By, self.WPy],
                           ['z', self.WPz, self.Gz, self.Bz, self.WPz]],
                           headers=['', 'Red', 'Green', 'Blue', 'WhitePoint'],
                           tablefmt='orgtbl'
                         )
-        with temporary_data_change(self, f'\n{table}'):
-            return super().__str__()
+        return f'\n{table}'
 
 """Points raw chunk type to desired class type
 
@@ -190,9 +323,24 @@ If during parse process, incoming chunk will not be matched with any chunk from
 CHUNKTYPES = {
     b'IHDR': IHDR,
     b'PLTE': PLTE,
+    b'tRNS': tRNS,
     b'IDAT': IDAT,
     b'IEND': IEND,
     b'tIME': tIME,
     b'gAMA': gAMA,
     b'cHRM': cHRM,
 }
+
+def create_chunk(type_, data):
+    """Create brand new chunk (not read from any file) with computed length and CRC fields
+
+    Args:
+        type_(bytes): Chunk type, e.g. b'IDAT'
+        data(bytes): Chunk data
+
+    Returns:
+        Chunk: Object of class that CHUNKTYPES is pointing to
+    """
+    length = len(data).to_bytes(Chunk.LENGTH_FIELD_LEN, 'big')
+    crc = zlib.crc32(data, zlib.crc32(type_)).to_bytes(Chunk.CRC_FIELD_LEN, 'big')
+    return CHUNKTYPES.get(type_, Chunk)(length, type_, data, crc)
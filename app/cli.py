@@ -1,21 +1,35 @@
 import logging
+import sys
+import time
 import traceback
 from pngparser import PngParser
-from pngImage import Png
+from pngImage import Png, clean_files, print_record_json, verify_files
+from optimizer import Optimizer
+from batch import expand_paths, get_record, run_batch, write_ndjson
+from metadatacache import MetadataCache
+from renderer import render
 from rsa import _RSA
+from keygenerator import KeyGenerator
+from keystore import KeyStore, get_default_key_id
+from lazyimport import lazy_import
 
 try:
-    import cv2
     import fire
-    import matplotlib.pyplot as plt
-    import numpy as np
 except ModuleNotFoundError:
     traceback.print_exc()
     print("\033[1;33mBefore you will debug, please delete 'venv' dir from project root and try again.\033[0m")
     exit(1)
 
+plt = lazy_import('matplotlib.pyplot')
+np = lazy_import('numpy')
+tabulate = lazy_import('tabulate')
+
 log = logging.getLogger()
 
+def as_tuple(value):
+    # fire passes single value (e.g. --levels=9) as it is, not as a tuple
+    return value if isinstance(value, (tuple, list)) else (value,)
+
 class CLI:
     """Provides access to package functionality
 
@@ -31,8 +45,13 @@ class CLI:
     COMMANDS:
      - metadata
      - print
+     - render
      - clean
+     - verify
+     - optimize
+     - batch
      - fullservice
+     - keygen
 
     For more, please read README.
 
@@ -40,57 +59,117 @@ class CLI:
         file_name (str, optional): Optional. Defaults to png_files/dice.png. Path to your png file. 
         verbose (bool, optional):  Optional. Defaults to False. Print additional logs which should help in application debugging proccess.
         no_gamma (bool, optional): OPtional. Determines, whether gamma should be aplied (if exists).
+        adam7_passes (int, optional): Optional. Defaults to 7. For interlaced images decode only the first N Adam7 passes,
+                                      which gives a cheap, low-resolution preview.
+        verify_crc (bool, optional): Optional. Check CRC of every chunk while file is parsed and fail on corrupted chunk.
     """
 
-    def __init__(self, file_name="png_files/dice.png", verbose=False, no_gamma=False):
+    def __init__(self, file_name="png_files/dice.png", verbose=False, no_gamma=False, adam7_passes=7, verify_crc=False):
         logging.basicConfig(level=logging.INFO,
                             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         self.file_name = file_name
         self.verbose = verbose
         self.no_gamma = no_gamma
+        self.adam7_passes = adam7_passes
+        self.verify_crc = verify_crc
 
         if self.verbose:
             log.setLevel(logging.DEBUG)
 
-        self.png = Png(self.file_name)
-        self.png.parse(no_gamma)
+        # PNG is opened when some command uses it for the first time (batch commands may not use it at all)
+        self._png = None
+
+    @property
+    def png(self):
+        if self._png is None:
+            self._png = Png(self.file_name)
+            # Only chunks are read here. Pixels are reconstructed when some command accesses them for the first time.
+            self._png.parse(self.no_gamma, self.adam7_passes, self.verify_crc)
+        return self._png
+
+    @png.setter
+    def png(self, value):
+        self._png = value
 
     def __del__(self):
         # Show image if it has been loaded to memory by plt.imshow()
-        # This is the very last thing in the program execution
-        plt.show()
+        # This is the very last thing in the program execution. Commands which do not plot anything never import matplotlib.
+        if plt.is_imported():
+            plt.show()
 
-    def metadata(self, idat=False, plte=False):
+    def metadata(self, idat=False, plte=False, format='text', no_cache=False, cache_path=None,
+                 cache_size=MetadataCache.DEFAULT_MAX_ENTRIES):
         """Print PNG's metadata in good-looking way
+
+        JSON formats use the same metadata cache as batch metadata command, so file, which has not changed since
+        the last query, is not parsed again. Text format always parses file.
+
+        Args:
+            idat (bool, optional): Optional. Print IDAT data.
+            plte (bool, optional): Optional. Print PLTE data.
+            format (str, optional): Optional. Defaults to text. text, json (single object) or ndjson (chunk per line).
+            no_cache (bool, optional): Optional. json and ndjson - always parse file, do not use metadata cache.
+            cache_path (str, optional): Optional. json and ndjson - path of cache database. Defaults to file in user's cache directory.
+            cache_size (int, optional): Optional. json and ndjson - maximum number of cached files. Least recently used ones are evicted.
         """
         log.debug("Printing metadata")
-        self.png.print_chunks(idat, plte)
+        if format == 'text':
+            self.png.print_chunks(idat, plte)
+        elif format in ('json', 'ndjson') and (no_cache or self.verify_crc):
+            # CRC verification is a part of parsing, so it can't be skipped by the cache
+            self.png.print_chunks_json(idat, plte, ndjson=format == 'ndjson')
+        elif format in ('json', 'ndjson'):
+            cache = MetadataCache(cache_path, cache_size)
+            try:
+                record, cached = get_record('metadata', self.file_name, {}, cache)
+                if not cached:
+                    cache.evict()
+            finally:
+                cache.close()
+            log.debug(f"Metadata record {'taken from cache' if cached else 'stored in cache'}")
+            print_record_json(self.file_name, record, idat, plte, ndjson=format == 'ndjson')
+        else:
+            log.error(f"Unknown metadata format: {format}. Quitting...")
+            exit(1)
 
     def print(self):
         """Print PNG from reconstructed IDAT data using matplotlib
         """
         log.debug("Printing file")
-        width = self.png.get_chunk_by_type(b'IHDR').width
-        height = self.png.get_chunk_by_type(b'IHDR').height
+        pixels = self.png.reconstructed_idat_data
+        ihdr_chunk = self.png.get_chunk_by_type(b'IHDR')
+        if pixels.dtype == np.uint16:
+            # matplotlib understands only 8-bit integer colors, so 16-bit samples are reduced to their high-order bytes
+            pixels = (pixels >> 8).astype(np.uint8)
         if self.png.bytesPerPixel == 1:
-            # greyscale
-            plt.imshow(np.array(self.png.reconstructed_idat_data).reshape((height, width)), cmap='gray', vmin=0, vmax=255)
+            # greyscale (1, 2, 4 and 8-bit samples keep their original range)
+            plt.imshow(pixels[:, :, 0], cmap='gray', vmin=0, vmax=2 ** min(ihdr_chunk.bit_depth, 8) - 1)
         elif self.png.bytesPerPixel == 2:
             # greyscale with alpha channel
-            self.png.reconstructed_idat_data = np.array(self.png.reconstructed_idat_data).reshape((height, width, self.png.bytesPerPixel))
-            grayscale = self.png.reconstructed_idat_data[:, :, 0]
-            alpha = self.png.reconstructed_idat_data[:, :, 1]
+            grayscale = pixels[:, :, 0]
+            alpha = pixels[:, :, 1]
             rgb_img = np.dstack((grayscale, grayscale, grayscale, alpha))
             plt.imshow(rgb_img)
         else:
             # truecolor, truecolor with alpha channel, pallette
-            plt.imshow(np.array(self.png.reconstructed_idat_data).reshape((height, width, self.png.bytesPerPixel)))
+            plt.imshow(pixels)
+
+    def render(self, output_file='preview.png', size=None, keep_alpha=False, background=None):
+        """Write preview of PNG to a new file, without matplotlib (works on headless machines)
+
+        Args:
+            output_file (str, optional): Optional. Defaults to preview.png. Path of preview.
+            size (int, optional): Optional. Thumbnail mode - maximum width and height of preview. Defaults to full size.
+            keep_alpha (bool, optional): Optional. Keep alpha channel instead of compositing image over background.
+            background (str, optional): Optional. Hex RGB color (e.g. ffffff) used for compositing. Defaults to bKGD chunk or white.
+        """
+        render(self.png, output_file, size, keep_alpha, background)
 
     def spectrum(self):
         """ Print FFT of an image (shows magnitude and phase)
             Compare original image and inverted fft of original image (checks transformation)
         """
-        img=cv2.imread(self.file_name,0)
+        img = self.png.get_grayscale_pixels()
         fourier = np.fft.fft2(img) 
         fourier_shifted = np.fft.fftshift(fourier) 
     
@@ -118,10 +197,131 @@ class CLI:
 
 
 
-    def clean(self, output_file='new.png'):
+    def clean(self, *file_names, output_file='new.png', in_place=False, output_dir=None):
         """Create brand new file with chunks that are TOTTALLY NECESSARY. Other chunks are discarded
+
+        Chunks are copied straight from the source file, pixels are never decoded.
+
+        Args:
+            file_names: Optional. Batch mode - clean these files instead of the --file-name one.
+            output_file (str, optional): Optional. Defaults to new.png. Where clean copy of --file-name is written.
+            in_place (bool, optional): Optional. Replace original file(s) with clean copies (atomically).
+            output_dir (str, optional): Optional. Batch mode - directory, where clean copies are written.
+        """
+        if file_names:
+            clean_files(file_names, output_dir, in_place)
+        elif in_place:
+            self.png.create_clean_copy(self.file_name)
+        else:
+            self.png.create_clean_copy(output_file)
+
+    def verify(self, *file_names, workers=None):
+        """Check CRC of every chunk and report corrupted ones
+
+        Chunks (and files) are verified by parallel threads.
+
+        Args:
+            file_names: Optional. Batch mode - verify these files instead of the --file-name one.
+            workers (int, optional): Optional. Number of threads.
+        """
+        results, bytes_verified, elapsed = verify_files(list(file_names) or [self.file_name], workers)
+
+        all_valid = True
+        for file_name, chunk_results, error in results:
+            print(f"\033[1m{file_name}\033[0m")
+            if error:
+                all_valid = False
+                print(f"  ERROR: {error}")
+                continue
+            for i, (chunk, computed_crc, is_valid) in enumerate(chunk_results, 1):
+                all_valid = all_valid and is_valid
+                status = "OK" if is_valid else f"CORRUPTED (computed: {computed_crc:08x})"
+                print(f"  CHUNK #{i} {chunk.type_.decode('utf-8', 'replace')} | Length: {len(chunk.data)} | CRC: {chunk.crc.hex()} | {status}")
+
+        print(f"Verified {bytes_verified} bytes in {elapsed:.3f} s ({bytes_verified / max(elapsed, 1e-9) / 2 ** 20:.1f} MiB/s)")
+        if not all_valid:
+            exit(1)
+
+    def optimize(self, output_file='optimized.png', filters=(0, 1, 2, 3, 4, 'adaptive', 'brute'), levels=(6, 9),
+                    strategies=('default', 'filtered'), mem_levels=(8, 9), workers=None, strip=False):
+        """Re-encode IDAT data to make the file smaller
+
+        Every combination of given filter strategies and zlib settings is tried in parallel processes.
+        The smallest result is written to output file. Pixels stay exactly the same.
+
+        Args:
+            output_file (str, optional): Optional. Defaults to optimized.png. Path of optimized file.
+            filters (tuple, optional): Optional. Filter types (0-4), 'adaptive' (minimum sum of absolute differences) or 'brute' (compress every row with every filter).
+            levels (tuple, optional): Optional. zlib compression levels.
+            strategies (tuple, optional): Optional. zlib strategies: default, filtered, huffman, rle, fixed.
+            mem_levels (tuple, optional): Optional. zlib memLevels (1-9).
+            workers (int, optional): Optional. Number of processes.
+            strip (bool, optional): Optional. Keep only critical chunks, just as clean command does.
         """
-        self.png.create_clean_copy(output_file)
+        optimizer = Optimizer(self.png, as_tuple(filters), as_tuple(levels), as_tuple(strategies), as_tuple(mem_levels), workers)
+        results = optimizer.run()
+
+        original_len = optimizer.get_original_idat_data_len()
+        print(tabulate.tabulate([[*trial, idat_len, f"{100 * idat_len / original_len:.1f}%", f"{elapsed:.3f}"] for trial, idat_len, elapsed in results],
+                        headers=['Filter', 'Level', 'Strategy', 'MemLevel', 'IDAT size', 'Of original', 'Time [s]'],
+                        tablefmt='orgtbl'))
+        best_trial, best_len, _ = min(results, key=lambda result: result[1])
+        print(f"Original IDAT size: {original_len} | Best IDAT size: {best_len} ({best_trial})")
+
+        optimizer.write(output_file, strip)
+
+    def batch(self, operation, *paths, workers=None, chunk_size=64, output=None, progress=True, output_dir=None, in_place=False,
+                filters='adaptive', levels=9, strategies='default', mem_levels=9, strip=False, size=None, keep_alpha=False, background=None, no_cache=False, cache_path=None,
+                cache_size=MetadataCache.DEFAULT_MAX_ENTRIES):
+        """Run metadata, verify, clean, optimize or render on many files in a process pool
+
+        Result of every file is printed as a single JSON line (NDJSON). Progress is reported on stderr.
+        Broken file does not stop processing of the others - its result contains an error.
+
+        Args:
+            operation (str): metadata, verify, clean, optimize or render.
+            paths: Files, directories (searched recursively for *.png) or glob patterns.
+            workers (int, optional): Optional. Number of processes.
+            chunk_size (int, optional): Optional. Defaults to 64. Number of files sent to a process at once.
+            output (str, optional): Optional. Write NDJSON to this file instead of stdout.
+            progress (bool, optional): Optional. Defaults to True. Report progress on stderr.
+            output_dir (str, optional): Optional. clean, optimize and render - directory, where new files are written.
+            in_place (bool, optional): Optional. clean, optimize and render - replace original files.
+            filters, levels, strategies, mem_levels, strip: Optional. optimize - see optimize command. Defaults to a single, cheap trial.
+            size, keep_alpha, background: Optional. render - see render command.
+            no_cache (bool, optional): Optional. metadata - always parse files, do not use metadata cache.
+            cache_path (str, optional): Optional. metadata - path of cache database. Defaults to file in user's cache directory.
+            cache_size (int, optional): Optional. metadata - maximum number of cached files. Least recently used ones are evicted.
+        """
+        if not self.verbose:
+            # Per-file logs of worker processes would flood the terminal
+            log.setLevel(logging.WARNING)
+
+        file_names = expand_paths(paths)
+        options = {
+            'output_dir': output_dir,
+            'in_place': in_place,
+            'filters': as_tuple(filters),
+            'levels': as_tuple(levels),
+            'strategies': as_tuple(strategies),
+            'mem_levels': as_tuple(mem_levels),
+            'strip': strip,
+            'size': size,
+            'keep_alpha': keep_alpha,
+            'background': background,
+            'cache': not no_cache,
+            'cache_path': cache_path,
+            'cache_size': cache_size,
+        }
+        results = run_batch(operation, file_names, options, workers, chunk_size)
+        if output:
+            with open(output, 'w') as f:
+                failed = write_ndjson(results, f, len(file_names), progress)
+        else:
+            failed = write_ndjson(results, sys.stdout, len(file_names), progress)
+
+        if failed:
+            exit(1)
 
     def fullservice(self, output_file='new.png', idat=False, plte=False):
         """Launch all functionality of package in controlled and automated way
@@ -146,7 +346,7 @@ class CLI:
         plt.title("Before cleanup", fontweight='bold', fontsize=20)
         self.metadata(idat, plte)
         self.print()
-        self.clean(output_file)
+        self.clean(output_file=output_file)
         self.spectrum()
 
         print('=' * 100)
@@ -155,7 +355,7 @@ class CLI:
         plt.subplot(122)
         plt.title("After cleanup", fontweight='bold', fontsize=20)
         new_png = Png(output_file)
-        new_png.parse(self.no_gamma)
+        new_png.parse(self.no_gamma, self.adam7_passes)
         original_png = self.png; self.png = new_png
         self.metadata(idat, plte)
         self.print()
@@ -165,9 +365,46 @@ class CLI:
         print_chunks_difference(original_png.chunks_count, self.png.chunks_count)
 
     
-    def rsa(self, key_size=1024, encrypted_file_path="encrypted.png", decrypted_file_path="decrypted.png", mode="ECB"):
+    def keygen(self, *key_sizes, public_exponent=None, workers=None, keystore_dir=None, force=False):
+        """Generate RSA key pairs and store them in keystore, so rsa and rsacompare commands do not have to generate them every time
+
+        Key pair of every size is stored as rsa-<size> (or rsa-<size>-e<public exponent>) and it may be used with --key flag,
+        e.g. rsa --key rsa-2048.
+
+        Args:
+            key_sizes: Optional. Defaults to 1024 and 2048. Bit lengths of keys.
+            public_exponent (int, optional): Optional. Fixed public exponent, e.g. 65537. Defaults to random full-size one.
+            workers (int, optional): Optional. Number of processes searching for primes.
+            keystore_dir (str, optional): Optional. Keystore directory. Defaults to directory in user's data directory.
+            force (bool, optional): Optional. Replace key pairs, which already exist.
+        """
+        keystore = KeyStore(keystore_dir)
+        for key_size in key_sizes or (1024, 2048):
+            key_id = get_default_key_id(key_size, public_exponent)
+            if keystore.contains(key_id) and not force:
+                print(f"{key_id}: {keystore.get_path(key_id)} (already exists)")
+                continue
+            start_time = time.perf_counter()
+            try:
+                public_key, private_key = KeyGenerator(key_size, public_exponent, workers).generateKeys()
+            except ValueError as error:
+                log.error(f"{error} Quitting...")
+                exit(1)
+            elapsed = time.perf_counter() - start_time
+            print(f"{key_id}: {keystore.save(public_key, private_key, key_id)} (generated in {elapsed:.2f} s)")
+
+    def _get_rsa(self, key_size, workers, public_exponent, key, keystore_dir):
+        try:
+            return _RSA(key_size, workers, public_exponent=public_exponent, key=key, keystore=KeyStore(keystore_dir))
+        except (FileNotFoundError, ValueError) as error:
+            log.error(f"{error} Quitting...")
+            exit(1)
+
+    def rsa(self, key_size=1024, encrypted_file_path="encrypted.png", decrypted_file_path="decrypted.png", mode="ECB", workers=None,
+            public_exponent=None, key=None, keystore_dir=None):
         assert self.png.get_chunk_by_type(b'IHDR').color_type != 3, "RSA module do not support pallette"
-        rsa = RSA(key_size)
+        assert self.png.get_chunk_by_type(b'IHDR').bit_depth == 8, "RSA module supports only 8-bit samples"
+        rsa = self._get_rsa(key_size, workers, public_exponent, key, keystore_dir)
 
         if mode == "ECB":
             cipher, after_iend_data_embedded = rsa.ECB_encrypt(self.png.reconstructed_idat_data)
@@ -191,9 +428,11 @@ class CLI:
                                     new_png.get_chunk_by_type(b"IHDR").height, decrypted_file_path)
 
 
-    def rsacompare(self, key_size=1024, encrypted_file_path_cbc="encrypted_cbc.png", encrypted_file_path_ecb="encrypted_ecb.png", encrypted_file_path_crypto="encrypted_crypto.png"):
+    def rsacompare(self, key_size=1024, encrypted_file_path_cbc="encrypted_cbc.png", encrypted_file_path_ecb="encrypted_ecb.png", encrypted_file_path_crypto="encrypted_crypto.png",
+                    workers=None, public_exponent=None, key=None, keystore_dir=None):
         assert self.png.get_chunk_by_type(b'IHDR').color_type != 3, "RSA module do not support pallette"
-        rsa = _RSA(key_size)
+        assert self.png.get_chunk_by_type(b'IHDR').bit_depth == 8, "RSA module supports only 8-bit samples"
+        rsa = self._get_rsa(key_size, workers, public_exponent, key, keystore_dir)
         
         # ECB
         cipher, after_iend_data_embedded = rsa.ECB_encrypt(self.png.reconstructed_idat_data)
@@ -0,0 +1,242 @@
+from lazyimport import lazy_import
+
+np = lazy_import('numpy')
+
+# Filter types that can appear as the first byte of every scanline
+# https://www.w3.org/TR/2003/REC-PNG-20031110/#9Filter-types
+FILTER_NONE = 0
+FILTER_SUB = 1
+FILTER_UP = 2
+FILTER_AVERAGE = 3
+FILTER_PAETH = 4
+FILTER_TYPES = [FILTER_NONE, FILTER_SUB, FILTER_UP, FILTER_AVERAGE, FILTER_PAETH]
+
+# Filter strategy which chooses filter for every scanline separately - see filter_scanlines
+ADAPTIVE_FILTER_STRATEGY = 'adaptive'
+# Filter strategy which tries to compress every scanline with every filter - see pngwriter.PngWriter.choose_filters_by_compression
+BRUTE_FORCE_FILTER_STRATEGY = 'brute'
+
+# Paeth predictor table - see get_paeth_table
+_paeth_table = None
+
+def get_paeth_table():
+    """Return Paeth predictor for every pair of differences (a - c, b - c), built on the first use
+
+    Predictor of Paeth filter is one of a, b, c and which one is chosen depends only on a - c and b - c:
+    pa = |b - c|, pb = |a - c|, pc = |(a - c) + (b - c)|. So (predictor - c) is looked up in flat list, where
+    item (b - c + 255) * 511 + (a - c + 255) is stored. 511 x 511 list replaces branches executed for every byte.
+    """
+    global _paeth_table
+    if _paeth_table is None:
+        differences = np.arange(-255, 256)
+        b_minus_c, a_minus_c = np.meshgrid(differences, differences, indexing='ij')
+        pa, pb, pc = np.abs(b_minus_c), np.abs(a_minus_c), np.abs(a_minus_c + b_minus_c)
+        _paeth_table = np.where((pa <= pb) & (pa <= pc), a_minus_c, np.where(pb <= pc, b_minus_c, 0)).ravel().tolist()
+    return _paeth_table
+
+def defilter_scanline(filter_type, scanline, previous, bytes_per_pixel, out):
+    """Reconstruct one scanline
+
+    None and Up filters are plain vectorized additions and Sub filter is a cumulative sum of every channel.
+
+    Average and Paeth filters are NOT vectorized: every reconstructed byte depends on the reconstructed byte on its left
+    (the same channel of previous pixel), so they are computed byte by byte, in plain python. Scanlines are decoded
+    one by one (see iter_defilter), so there is no other axis to vectorize along, and numpy calls on single pixels
+    cost more than they save. What does not depend on the left byte is computed upfront, with numpy, for the whole
+    scanline, and every channel is reconstructed by its own tight loop, so only a few operations per byte are left:
+    - Average: recon = x + (a + b) // 2
+    - Paeth: recon = (x + c) + table[base + a], where base is computed from b and c - see get_paeth_table.
+      With a zero prior row Paeth is the same as Sub, which is vectorized.
+
+    Args:
+        filter_type(int): First byte of scanline
+        scanline(np.ndarray): Filtered bytes of scanline (without filter type byte), dtype uint8
+        previous(np.ndarray): Reconstructed previous scanline. For the first scanline it must be filled with zeros
+        bytes_per_pixel(int): Distance (in bytes) to the corresponding byte of the pixel on the left
+        out(np.ndarray): Array (of scanline length) that reconstructed bytes are written into
+    """
+    if filter_type == FILTER_NONE:
+        out[:] = scanline
+    elif filter_type == FILTER_SUB:
+        # uint8 accumulator wraps around, which is exactly the modulo 256 that PNG specification demands
+        np.cumsum(scanline.reshape(-1, bytes_per_pixel), axis=0, dtype=np.uint8, out=out.reshape(-1, bytes_per_pixel))
+    elif filter_type == FILTER_UP:
+        np.add(scanline, previous, out=out)
+    elif filter_type == FILTER_AVERAGE:
+        channels_out = out.reshape(-1, bytes_per_pixel)
+        # Every channel is a separate sequence: byte on the left is the previous item of the same channel
+        for channel, (filtered, up) in enumerate(zip(scanline.reshape(-1, bytes_per_pixel).T.tolist(),
+                                                     previous.reshape(-1, bytes_per_pixel).T.tolist())):
+            recon = []
+            append = recon.append
+            a = 0
+            for x, b in zip(filtered, up):
+                a = (x + ((a + b) >> 1)) & 0xff
+                append(a)
+            channels_out[:, channel] = recon
+    elif filter_type == FILTER_PAETH:
+        if not previous.any():
+            # With a zero prior row Paeth predictor always picks the byte on the left, so it is the same as Sub
+            return defilter_scanline(FILTER_SUB, scanline, previous, bytes_per_pixel, out)
+
+        table = get_paeth_table()
+        # b - byte above, c - byte above on the left (0 for the first pixel)
+        b = previous.astype(np.int32)
+        c = np.zeros_like(b)
+        c[bytes_per_pixel:] = b[:-bytes_per_pixel]
+        # table[base + a] = predictor - c
+        base = (b - c + 255) * 511 + 255 - c
+        x_plus_c = scanline + c
+
+        channels_out = out.reshape(-1, bytes_per_pixel)
+        for channel, (x_plus_c_channel, base_channel) in enumerate(zip(x_plus_c.reshape(-1, bytes_per_pixel).T.tolist(),
+                                                                       base.reshape(-1, bytes_per_pixel).T.tolist())):
+            recon = []
+            append = recon.append
+            a = 0
+            for xc, k in zip(x_plus_c_channel, base_channel):
+                a = (xc + table[k + a]) & 0xff
+                append(a)
+            channels_out[:, channel] = recon
+    else:
+        raise Exception('unknown filter type: ' + str(filter_type))
+
+def iter_defilter(filtered_stream, height, stride, bytes_per_pixel):
+    """Reconstruct scanlines as soon as they are complete
+
+    Only incomplete scanline and the previous reconstructed one are kept in memory, so memory usage
+    does not depend on the image height.
+
+    Args:
+        filtered_stream(iterable): Pieces of decompressed IDAT data, of any length
+        height(int): Number of scanlines
+        stride(int): Length of scanline in bytes (without filter type byte)
+        bytes_per_pixel(int): Distance (in bytes) to the corresponding byte of the pixel on the left
+
+    Yields:
+        np.ndarray: uint8 array of length stride with reconstructed scanline
+    """
+    return iter_defilter_images(filtered_stream, [(height, stride)], bytes_per_pixel)
+
+def iter_defilter_images(filtered_stream, images, bytes_per_pixel):
+    """Reconstruct scanlines of several images stored one after another in the same stream
+
+    It is used for interlaced PNG, where every Adam7 pass is a separate image. Each image is defiltered
+    on its own - the first scanline of every image has no previous scanline.
+
+    Args:
+        filtered_stream(iterable): Pieces of decompressed IDAT data, of any length
+        images(list): (height, stride) of every image, in order of appearance. Empty images must be skipped.
+        bytes_per_pixel(int): Distance (in bytes) to the corresponding byte of the pixel on the left
+
+    Yields:
+        np.ndarray: uint8 array with reconstructed scanline. Scanlines of the first image go first, then of the second one, etc.
+    """
+    pending = bytearray()
+    image = 0
+    rows_done = 0
+    previous = np.zeros(images[0][1], dtype=np.uint8)
+
+    for piece in filtered_stream:
+        pending += piece
+        consumed = 0
+        scanline = None
+        while image < len(images):
+            height, stride = images[image]
+            if len(pending) - consumed < stride + 1:
+                break
+
+            scanline = np.frombuffer(pending, dtype=np.uint8, count=stride + 1, offset=consumed)
+            reconstructed = np.empty(stride, dtype=np.uint8)
+            defilter_scanline(scanline[0], scanline[1:], previous, bytes_per_pixel, reconstructed)
+            consumed += stride + 1
+            previous = reconstructed
+
+            rows_done += 1
+            if rows_done == height:
+                image += 1
+                rows_done = 0
+                if image < len(images):
+                    previous = np.zeros(images[image][1], dtype=np.uint8)
+            yield reconstructed
+
+        # frombuffer view must be released before bytearray can be resized
+        del scanline
+        del pending[:consumed]
+        assert image < len(images) or not pending, "Image's decompressed IDAT data is longer than expected. Corrupted image"
+
+    assert image == len(images), "Image's decompressed IDAT data is shorter than expected. Corrupted image"
+
+def filter_scanlines(scanlines, bytes_per_pixel, strategy=ADAPTIVE_FILTER_STRATEGY):
+    """Filter whole image at once. It is the reverse of defiltering.
+
+    Unlike defiltering, every filter depends only on original (unfiltered) bytes, so all of them are
+    computed for the whole image with vectorized operations.
+
+    Args:
+        scanlines(np.ndarray): uint8 array of shape (height, stride) with packed (unfiltered) scanlines
+        bytes_per_pixel(int): Distance (in bytes) to the corresponding byte of the pixel on the left
+        strategy: One of FILTER_TYPES - the same filter is used for every scanline, or ADAPTIVE_FILTER_STRATEGY -
+                  for every scanline the filter with minimum sum of absolute differences is chosen (bytes are
+                  treated as signed, just as libpng heuristic does), or array with filter type of every scanline.
+
+    Returns:
+        np.ndarray: uint8 array of shape (height, stride + 1). First byte of every scanline is its filter type.
+    """
+    height, stride = scanlines.shape
+    filtered = np.empty((height, stride + 1), dtype=np.uint8)
+
+    if isinstance(strategy, np.ndarray):
+        candidates = [filter_all_scanlines(scanlines, bytes_per_pixel, filter_type) for filter_type in FILTER_TYPES]
+        filtered[:, 0] = strategy
+        filtered[:, 1:] = np.choose(strategy[:, np.newaxis], candidates)
+    elif strategy == ADAPTIVE_FILTER_STRATEGY:
+        candidates = [filter_all_scanlines(scanlines, bytes_per_pixel, filter_type) for filter_type in FILTER_TYPES]
+        # Sum of absolute values of filtered bytes interpreted as signed -> the smaller, the better it compresses
+        costs = np.stack([np.abs(candidate.view(np.int8).astype(np.int32)).sum(axis=1) for candidate in candidates])
+        chosen = np.argmin(costs, axis=0)
+        filtered[:, 0] = chosen
+        filtered[:, 1:] = np.choose(chosen[:, np.newaxis], candidates)
+    else:
+        assert strategy in FILTER_TYPES, f"Unknown filter strategy: {strategy}"
+        filtered[:, 0] = strategy
+        filtered[:, 1:] = filter_all_scanlines(scanlines, bytes_per_pixel, strategy)
+
+    return filtered
+
+def filter_all_scanlines(scanlines, bytes_per_pixel, filter_type):
+    """Apply single filter type to every scanline
+
+    Args:
+        scanlines(np.ndarray): uint8 array of shape (height, stride) with packed (unfiltered) scanlines
+        bytes_per_pixel(int): Distance (in bytes) to the corresponding byte of the pixel on the left
+        filter_type(int): One of FILTER_TYPES
+
+    Returns:
+        np.ndarray: uint8 array of shape (height, stride) with filtered bytes (without filter type bytes)
+    """
+    if filter_type == FILTER_NONE:
+        return scanlines.copy()
+
+    # a - byte on the left, b - byte above, c - byte above on the left. Bytes outside of image are 0.
+    a = np.zeros_like(scanlines)
+    a[:, bytes_per_pixel:] = scanlines[:, :-bytes_per_pixel]
+    if filter_type == FILTER_SUB:
+        return scanlines - a
+
+    b = np.zeros_like(scanlines)
+    b[1:] = scanlines[:-1]
+    if filter_type == FILTER_UP:
+        return scanlines - b
+    if filter_type == FILTER_AVERAGE:
+        return scanlines - ((a.astype(np.uint16) + b) >> 1).astype(np.uint8)
+
+    assert filter_type == FILTER_PAETH, f"Unknown filter type: {filter_type}"
+    c = np.zeros_like(scanlines)
+    c[1:, bytes_per_pixel:] = scanlines[:-1, :-bytes_per_pixel]
+    a16, b16, c16 = a.astype(np.int16), b.astype(np.int16), c.astype(np.int16)
+    pa = np.abs(b16 - c16)
+    pb = np.abs(a16 - c16)
+    pc = np.abs(a16 + b16 - 2 * c16)
+    predictor = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+    return scanlines - predictor
@@ -1,35 +1,111 @@
 import random, sys, os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# Standard public exponent - small, so encryption is fast, but big enough to be safe
+DEFAULT_PUBLIC_EXPONENT = 65537
+
+def sieve_primes(limit):
+    """Return list of all primes smaller than limit (sieve of Eratosthenes)
+    """
+    is_prime = bytearray([1]) * limit
+    is_prime[:2] = b'\x00\x00'
+    for i in range(2, int(limit ** 0.5) + 1):
+        if is_prime[i]:
+            is_prime[i * i::i] = bytes(len(range(i * i, limit, i)))
+    return [i for i, prime in enumerate(is_prime) if prime]
+
+# Odd primes used to sieve out candidates before Miller-Rabin test
+SMALL_PRIMES = sieve_primes(2 ** 13)[1:]
+# Number of consecutive odd candidates sieved at once
+SIEVE_WINDOW = 2 ** 12
+# Below it there are too few primes with two top bits set to find two different ones (and RSA blocks would be empty)
+MIN_KEY_SIZE = 16
+
+def isProbablePrime(num, rng, trials=5):
+    """Miller-Rabin test with random witnesses taken from rng
+    """
+    if num % 2 == 0 or num < 2:
+        return num == 2 # Rabin-Miller doesn't work on even integers.
+    if num == 3:
+        return True
+    s = num - 1
+    t = 0
+    while s % 2 == 0:
+        s = s // 2
+        t += 1
+    for _ in range(trials):
+        a = rng.randrange(2, num - 1)
+        v = pow(a, s, num)
+        if v != 1:
+            i = 0
+            while v != (num - 1):
+                if i == t - 1:
+                    return False
+                i = i + 1
+                v = pow(v, 2, num)
+    return True
+
+def searchPrime(bits, seed, windows=1):
+    """Look for a prime of exactly given bit length in windows of consecutive odd numbers
+
+    Every window starts at a random odd number with two top bits set (so product of two such primes has exactly 2 * bits bits).
+    Multiples of SMALL_PRIMES are crossed out of the window first - only the remaining candidates go to Miller-Rabin test.
+    Only primes smaller than the window are used, so small prime itself (possible for short bit lengths) is never crossed out.
+    It is executed by worker processes of parallel search too, so it takes its own seed instead of using global random state.
+
+    Args:
+        bits(int): Bit length of prime
+        seed(int): Seed of random generator
+        windows(int): Number of windows to search
+
+    Returns:
+        int: Prime or None, if there is no prime in searched windows
+    """
+    rng = random.Random(seed)
+    for _ in range(windows):
+        start = rng.getrandbits(bits) | (3 << (bits - 2)) | 1
+        # composite[k] is set if start + 2k is divisible by any of small primes
+        composite = bytearray(SIEVE_WINDOW)
+        for prime in SMALL_PRIMES:
+            if prime >= start:
+                break
+            # start + 2k = 0 (mod prime) <=> k = -start * 2^-1 (mod prime)
+            k = (prime - start % prime) * ((prime + 1) // 2) % prime
+            composite[k::prime] = b'\x01' * len(range(k, SIEVE_WINDOW, prime))
+        for k, is_composite in enumerate(composite):
+            candidate = start + 2 * k
+            if candidate.bit_length() != bits:
+                break
+            if not is_composite and isProbablePrime(candidate, rng):
+                return candidate
+    return None
 
 class KeyGenerator:
-    def __init__(self, keysize):
+    """Generate RSA key pair
+
+    Args:
+        keysize(int): Bit length of modulus
+        public_exponent(int): If it is set (e.g. to DEFAULT_PUBLIC_EXPONENT), it is used as e. Otherwise, e is a random keysize-bit number.
+        workers(int): Number of processes searching for primes. With 1 (default) primes are searched in current process.
+    """
+    def __init__(self, keysize, public_exponent=None, workers=1):
+        if keysize < MIN_KEY_SIZE:
+            raise ValueError(f"Key size must be at least {MIN_KEY_SIZE} bits, got {keysize}.")
+        if keysize % 2:
+            # Both primes have keysize / 2 bits with two top bits set, so modulus always has even number of bits
+            raise ValueError(f"Key size must be even, got {keysize}.")
         self.keysize=keysize
-        self.primesize = keysize/2
+        self.primesize = keysize // 2
+        self.public_exponent = public_exponent
+        self.workers = workers or os.cpu_count() or 1
         self.n=0
         self.e=0
         self.d=0
+        self.p=0
+        self.q=0
 
     def isPrime(self, num):
-        if num % 2 == 0 or num < 2:
-            return False # Rabin-Miller doesn't work on even integers.
-        if num == 3:
-            return True
-        s = num - 1
-        t = 0
-        while s % 2 == 0:
-            s = s // 2
-            t += 1
-        for trials in range(5): 
-            a = random.randrange(2, num - 1)
-            v = pow(a, s, num)
-            if v != 1: 
-                 i = 0
-                 while v != (num - 1):
-                    if i == t - 1:
-                        return False
-                    else:
-                        i = i + 1
-                        v = (v ** 2) % num
-        return True
+        return isProbablePrime(num, random)
 
     def egcd(self, a, b):
         if a == 0:
@@ -45,59 +121,108 @@ class KeyGenerator:
 
     def generateLargePrime(self):
         while True:
-            num = random.randrange(2**(self.primesize-1), 2**(self.primesize))
-            if self.isPrime(num):
-                return num
-    
+            prime = searchPrime(self.primesize, random.getrandbits(64))
+            if prime:
+                return prime
+
+    def generateLargePrimes(self, count, executor=None):
+        """Find count distinct primes
+
+        With executor, windows are searched in parallel by its processes and search stops as soon as enough primes are found
+        (windows, which are still waiting, are cancelled).
+
+        Args:
+            count(int): Number of primes
+            executor(ProcessPoolExecutor): Optional. Pool of processes searching for primes.
+        """
+        if executor is None:
+            primes = set()
+            while len(primes) < count:
+                primes.add(self.generateLargePrime())
+            return list(primes)
+
+        primes = []
+        # Twice as many windows as workers, so workers never wait for the next one
+        pending = {executor.submit(searchPrime, self.primesize, random.getrandbits(64)) for _ in range(2 * self.workers)}
+        while len(primes) < count:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                prime = future.result()
+                if prime and prime not in primes and len(primes) < count:
+                    primes.append(prime)
+                elif len(primes) < count:
+                    pending.add(executor.submit(searchPrime, self.primesize, random.getrandbits(64)))
+        for future in pending:
+            future.cancel()
+        return primes
+
     def gcd(self, a, b): #gcd (greatest common divisor)
-        if b==0: 
-            return a 
-        else: 
-            return self.gcd(b,a%b) 
- 
+        # Iterative, because recursion depth of Euclid's algorithm exceeds Python limit for 2048+ bit keys
+        while b != 0:
+            a, b = b, a % b
+        return a
+
 
     def findModInverse(self, a, m):
-        
+
         if self.gcd(a, m) != 1:
             return None             # a,m -> must be relatively prime
 
         u1, u2, u3 = 1, 0, a
         v1, v2, v3 = 0, 1, m
         while v3 != 0:
-            q = u3 // v3 
+            q = u3 // v3
             v1, v2, v3, u1, u2, u3 = (u1 - q * v1), (u2 - q * v2), (u3 - q * v3), v1, v2, v3
         return u1 % m
 
 
     def generateKeys(self):
+        # Pool is started once and reused by all attempts
+        executor = ProcessPoolExecutor(self.workers) if self.workers > 1 else None
+        try:
+            return self.generateKeysWith(executor)
+        finally:
+            if executor is not None:
+                # Windows still waiting have been cancelled by generateLargePrimes, so only already running ones (a single bounded
+                # window per worker) are waited for. cancel_futures would need Python 3.9 and wait=False breaks pool's cleanup on 3.8.
+                executor.shutdown()
+
+    def generateKeysWith(self, executor):
 
         while True:
             p = 0
             q = 0
             while p == q or ((p-1)*(q-1)).bit_length() != self.keysize:
-                p = self.generateLargePrime()
-                q = self.generateLargePrime()
-        
-        
-            phi = (p-1)*(q-1) 
+                p, q = self.generateLargePrimes(2, executor)
+
+
+            phi = (p-1)*(q-1)
             n = p * q
             self.n = n
 
-            while True:
-                e = random.randrange(2 ** (self.keysize - 1), 2 ** (self.keysize))
-        
-                if self.gcd(e, phi) == 1 and e < phi:
-                    break
-        
+            if self.public_exponent:
+                e = self.public_exponent
+                if self.gcd(e, phi) != 1:
+                    # e must be invertible modulo phi - another primes are needed
+                    continue
+            else:
+                while True:
+                    e = random.randrange(2 ** (self.keysize - 1), 2 ** (self.keysize))
+
+                    if self.gcd(e, phi) == 1 and e < phi:
+                        break
+
             self.e = e
             #d = self.modinv(e, phi)
             d = self.findModInverse(e,phi)
             self.d = d
-        
+            self.p = p
+            self.q = q
+
             publicKey=(e,n)
-            privateKey=(d,n)
+            # CRT parameters (dP, dQ, qInv) allow to decrypt with two half-size exponentiations - see blockengine.rsa_pow
+            privateKey=(d,n,p,q,d % (p-1),d % (q-1),self.findModInverse(q,p))
 
-            if e.bit_length() == self.keysize and d.bit_length() == self.keysize:
+            # With random e, both exponents must be full-size. Fixed public exponent is small on purpose.
+            if self.public_exponent or (e.bit_length() == self.keysize and d.bit_length() == self.keysize):
                 return (publicKey, privateKey)
-
-    
\ No newline at end of file
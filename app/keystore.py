@@ -0,0 +1,110 @@
+import logging
+import os
+import tempfile
+from lazyimport import lazy_import
+
+RSA = lazy_import('Cryptodome.PublicKey.RSA')
+PEM = lazy_import('Cryptodome.IO.PEM')
+asn1 = lazy_import('Cryptodome.Util.asn1')
+
+log = logging.getLogger(__name__)
+
+def get_default_keystore_dir():
+    """Return path of keystore in user's data directory (XDG_DATA_HOME or ~/.local/share)
+    """
+    data_dir = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(data_dir, 'png-is-my-favourite-file-type', 'keys')
+
+def get_default_key_id(key_size, public_exponent=None):
+    """Return id under which keygen command stores key pair, e.g. rsa-2048 (random e) or rsa-2048-e65537
+    """
+    return f"rsa-{key_size}-e{public_exponent}" if public_exponent else f"rsa-{key_size}"
+
+class KeyStore:
+    """Directory of RSA key pairs, one PEM file (PKCS#1 RSAPrivateKey) per key pair
+
+    PKCS#1 private key holds not only n, e and d, but also p, q and CRT parameters (d mod (p-1), d mod (q-1), q^-1 mod p) -
+    exactly the private key used by blockengine.rsa_pow. So such files are loaded by decoding DER sequence only, which
+    takes about a millisecond, and no parameter has to be recomputed. Keys in other formats (e.g. PKCS#8 written by
+    openssl) are imported by Cryptodome, which is slower, because it checks the key.
+
+    Files are readable only by theirs owner.
+
+    Args:
+        directory(str): Path of keystore directory. Defaults to get_default_keystore_dir().
+    """
+    KEY_FILE_EXTENSION = '.pem'
+
+    def __init__(self, directory=None):
+        self.directory = directory or get_default_keystore_dir()
+
+    def get_path(self, key):
+        """Return path of key file
+
+        Args:
+            key(str): Key id (name of file in keystore without extension) or path of key file
+        """
+        if os.path.sep in key or key.endswith(self.KEY_FILE_EXTENSION) or os.path.isfile(key):
+            return key
+        return os.path.join(self.directory, key + self.KEY_FILE_EXTENSION)
+
+    def contains(self, key):
+        return os.path.isfile(self.get_path(key))
+
+    def save(self, public_key, private_key, key):
+        """Write key pair to key file (atomically - file is either old or new, never partially written)
+
+        Args:
+            public_key(tuple): (e, n)
+            private_key(tuple): (d, n, p, q, dP, dQ, qInv)
+            key(str): Key id or path of key file
+
+        Returns:
+            str: Path of key file
+        """
+        e, n = public_key
+        d, _, p, q = private_key[:4]
+        pem = RSA.construct((n, e, d, p, q)).export_key('PEM')
+
+        path = self.get_path(key)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # mkstemp creates file readable and writable only by its owner
+        temporary_fd, temporary_name = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+        try:
+            with os.fdopen(temporary_fd, 'wb') as file_handler:
+                file_handler.write(pem)
+            os.replace(temporary_name, path)
+        except:
+            os.unlink(temporary_name)
+            raise
+        log.debug(f"Saved {n.bit_length()} bit key pair to '{path}'")
+        return path
+
+    def load(self, key):
+        """Read key pair from key file
+
+        Args:
+            key(str): Key id or path of key file
+
+        Returns:
+            tuple: (public_key, private_key) - (e, n) and (d, n, p, q, dP, dQ, qInv)
+        """
+        path = self.get_path(key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"There is no key '{key}' ('{path}'). Generate it with keygen command.")
+        with open(path, 'r') as file_handler:
+            pem = file_handler.read()
+
+        der, marker, encrypted = PEM.decode(pem)
+        if marker == 'RSA PRIVATE KEY' and not encrypted:
+            # RSAPrivateKey ::= SEQUENCE { version, n, e, d, p, q, dP, dQ, qInv }
+            _, n, e, d, p, q, dP, dQ, qInv = asn1.DerSequence().decode(der, nr_elements=9, only_ints_expected=True)
+        else:
+            rsa_key = RSA.import_key(pem)
+            if not rsa_key.has_private():
+                raise ValueError(f"Key file '{path}' contains only public key")
+            n, e, d, p, q = rsa_key.n, rsa_key.e, rsa_key.d, rsa_key.p, rsa_key.q
+            dP, dQ, qInv = d % (p - 1), d % (q - 1), pow(q, -1, p)
+        log.debug(f"Loaded {n.bit_length()} bit key pair from '{path}'")
+        return (e, n), (d, n, p, q, dP, dQ, qInv)
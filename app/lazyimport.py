@@ -0,0 +1,36 @@
+import importlib
+import traceback
+
+class LazyModule:
+    """Module, which is imported when any of its attributes is accessed for the first time
+
+    Heavy third-party packages (numpy, matplotlib, tabulate, Cryptodome) are imported through it,
+    so every command pays only for packages it really uses. E.g. metadata command does not need numpy at all.
+
+    Args:
+        name(str): Full name of module, e.g. 'matplotlib.pyplot'
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def is_imported(self):
+        return self._module is not None
+
+def import_module(name):
+    try:
+        return importlib.import_module(name)
+    except ModuleNotFoundError:
+        traceback.print_exc()
+        print("\033[1;33mBefore you will debug, please delete 'venv' dir from project root and try again.\033[0m")
+        exit(1)
+
+def lazy_import(name):
+    """Return LazyModule of given name. It should be used instead of module-level import of heavy package
+    """
+    return LazyModule(name)
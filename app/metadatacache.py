@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+def get_default_cache_path():
+    """Return path of cache database in user's cache directory (XDG_CACHE_HOME or ~/.cache)
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'png-is-my-favourite-file-type', 'metadata.sqlite3')
+
+class MetadataCache:
+    """On-disk (SQLite) cache of parsed metadata of PNG files
+
+    Entry is valid only as long as file's path, size, modification time and inode are the same, so changed
+    (or replaced) file is parsed again. Cache is bounded - when it has more than max_entries entries,
+    least recently used ones are evicted (see evict).
+
+    Many processes can use the same cache at once - every one of them should create its own MetadataCache.
+
+    Args:
+        path(str): Path of database file. Defaults to get_default_cache_path().
+        max_entries(int): Maximum number of entries kept after eviction
+    """
+    DEFAULT_MAX_ENTRIES = 100000
+    # How long (in seconds) to wait for database locked by another process
+    LOCK_TIMEOUT = 30
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path or get_default_cache_path()
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        # Autocommit mode - every statement is a transaction on its own
+        self.connection = sqlite3.connect(self.path, timeout=self.LOCK_TIMEOUT, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS metadata (
+                                        path TEXT PRIMARY KEY,
+                                        size INTEGER NOT NULL,
+                                        mtime_ns INTEGER NOT NULL,
+                                        inode INTEGER NOT NULL,
+                                        record TEXT NOT NULL,
+                                        last_used REAL NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used)')
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def get_key(file_name):
+        """Return cache key of file: (absolute path, size, mtime in ns, inode)
+
+        Key should be taken BEFORE file is parsed, so entry of file modified during parsing is invalidated.
+        """
+        stat = os.stat(file_name)
+        return os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(self, key):
+        """Return cached metadata record (dict) or None, if there is no valid entry for key
+        """
+        row = self.connection.execute('SELECT record FROM metadata WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?',
+                                        key).fetchone()
+        if row is None:
+            return None
+        self.connection.execute('UPDATE metadata SET last_used = ? WHERE path = ?', (time.time(), key[0]))
+        return json.loads(row[0])
+
+    def put(self, key, record):
+        """Store metadata record (JSON-serializable dict). Previous entry of the same path is replaced.
+        """
+        self.connection.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)',
+                                (*key, json.dumps(record), time.time()))
+
+    def evict(self):
+        """Remove least recently used entries above max_entries limit
+
+        Returns:
+            int: Number of removed entries
+        """
+        entries = self.connection.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+        if entries <= self.max_entries:
+            return 0
+        self.connection.execute('DELETE FROM metadata WHERE path IN (SELECT path FROM metadata ORDER BY last_used LIMIT ?)',
+                                (entries - self.max_entries,))
+        log.debug(f"Evicted {entries - self.max_entries} metadata cache entries")
+        return entries - self.max_entries
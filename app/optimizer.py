@@ -0,0 +1,120 @@
+import logging
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from chunks import create_chunk
+from pngImage import Png
+from pngwriter import PngWriter
+
+log = logging.getLogger(__name__)
+
+"""Points zlib strategy name (used in command line) to zlib constant
+"""
+ZLIB_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+
+# Raw (defiltered, but packed) images of optimized PNG. Every worker process decodes PNG only once, in init_trial_worker.
+_raw_images = None
+_ihdr_chunk = None
+
+def init_trial_worker(file_name):
+    global _raw_images, _ihdr_chunk
+    png = Png(file_name)
+    png.parse(True)
+    _raw_images = png.parser.get_raw_images()
+    _ihdr_chunk = png.get_chunk_by_type(b'IHDR')
+
+def run_trial(trial):
+    """Filter and compress image with given settings
+
+    Args:
+        trial(tuple): (filter_strategy, compression_level, zlib_strategy_name, mem_level)
+
+    Returns:
+        tuple: (trial, compressed_data, elapsed_seconds)
+    """
+    filter_strategy, compression_level, zlib_strategy_name, mem_level = trial
+    start_time = time.perf_counter()
+    # Trials already run in parallel processes, so every trial compresses its data as a single block in a single thread
+    png_writer = PngWriter(_ihdr_chunk.width, _ihdr_chunk.height, _ihdr_chunk.color_type, _ihdr_chunk.bit_depth,
+                            filter_strategy, compression_level, ZLIB_STRATEGIES[zlib_strategy_name], mem_level,
+                            workers=1, deflate_block_len=2 ** 62)
+    compressed = png_writer.compress(png_writer.filter_images(_raw_images))
+    return trial, compressed, time.perf_counter() - start_time
+
+class Optimizer:
+    """Re-encode IDAT data of existing PNG to make it smaller
+
+    Every combination of filter strategy, zlib level, zlib strategy and zlib memLevel is tried in a process pool
+    and the smallest IDAT data wins. Pixels are not changed - IDAT is re-encoded from defiltered scanlines,
+    so bit depth, color type and interlacing stay the same.
+
+    Args:
+        png(Png): Parsed PNG
+        filter_strategies(iterable): Filter types (0-4), 'adaptive' or 'brute'
+        compression_levels(iterable): zlib levels
+        zlib_strategies(iterable): Names of zlib strategies - keys of ZLIB_STRATEGIES
+        mem_levels(iterable): zlib memLevels
+        workers(int): Number of processes. Defaults to ProcessPoolExecutor default.
+    """
+    def __init__(self, png, filter_strategies, compression_levels, zlib_strategies, mem_levels, workers=None):
+        self.png = png
+        for zlib_strategy_name in zlib_strategies:
+            assert zlib_strategy_name in ZLIB_STRATEGIES, f"Unknown zlib strategy: {zlib_strategy_name}. It must be one of: {list(ZLIB_STRATEGIES)}"
+        self.trials = list(product(filter_strategies, compression_levels, zlib_strategies, mem_levels))
+        self.workers = workers
+        self.best_idat_data = None
+
+    def run(self):
+        """Run all trials
+
+        Returns:
+            list: (trial, idat_data_len, elapsed_seconds) of every trial, in order of trials
+        """
+        log.info(f"Running {len(self.trials)} optimization trials")
+        if self.workers == 1:
+            # No process pool - e.g. optimizer itself runs in a worker process of batch command
+            init_trial_worker(self.png.file.name)
+            return self.collect_results(map(run_trial, self.trials))
+
+        with ProcessPoolExecutor(self.workers, initializer=init_trial_worker, initargs=(self.png.file.name,)) as executor:
+            return self.collect_results(executor.map(run_trial, self.trials))
+
+    def collect_results(self, trial_results):
+        results = []
+        for trial, compressed, elapsed in trial_results:
+            results.append((trial, len(compressed), elapsed))
+            if self.best_idat_data is None or len(compressed) < len(self.best_idat_data):
+                self.best_idat_data = compressed
+        return results
+
+    def get_original_idat_data_len(self):
+        return sum(len(chunk.data) for chunk in self.png.get_all_chunks_by_type(b'IDAT'))
+
+    def write(self, output_file, strip=False):
+        """Write PNG with the smallest IDAT data found by run. If no trial beats the original IDAT data, it is kept.
+
+        Chunks other than IDAT are copied from the original file (see Png.write_png).
+
+        Args:
+            output_file(str): Path of new file
+            strip(bool): If set to true, only critical chunks are kept (just as clean command does)
+        """
+        if self.best_idat_data is not None and len(self.best_idat_data) < self.get_original_idat_data_len():
+            idat_chunks = [create_chunk(b'IDAT', self.best_idat_data[i : i + PngWriter.MAX_IDAT_DATA_LEN])
+                            for i in range(0, len(self.best_idat_data), PngWriter.MAX_IDAT_DATA_LEN)]
+        else:
+            log.info("Original IDAT data is the smallest one, it is kept")
+            idat_chunks = self.png.get_all_chunks_by_type(b'IDAT')
+
+        chunks = self.png.chunks[:self.png.first_idat_position] + idat_chunks + self.png.chunks[self.png.last_idat_position + 1:]
+        if strip:
+            critical_chunk_types = self.png.get_critical_chunk_types()
+            chunks = [chunk for chunk in chunks if chunk.type_ in critical_chunk_types]
+        self.png.write_png(chunks, output_file)
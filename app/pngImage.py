@@ -1,11 +1,25 @@
+import json
 import logging
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
 import zlib
-from chunks import IDAT, PLTE, temporary_data_change
+from concurrent.futures import ThreadPoolExecutor
+from chunks import Chunk
 from pngparser import PngParser
+from lazyimport import lazy_import
+
+np = lazy_import('numpy')
 
 log = logging.getLogger(__name__)
 
 class Png:
+    # Maximal length of a single piece of decompressed IDAT data
+    DECOMPRESSION_PIECE_LEN = 2 ** 20
+
     def __init__(self, file_name):
         log.debug('Openning file')
         try:
@@ -13,85 +27,401 @@ class Png:
         except IOError as e:
             raise e
 
+        # File is memory-mapped, so reading chunks do not copy their data. Chunks get memoryview slices of
+        # this buffer, and OS loads only these pages of file, which are really accessed.
+        try:
+            self.buffer = memoryview(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ))
+        except ValueError:
+            # Empty file can't be mapped
+            self.buffer = memoryview(b'')
+
         self.PNG_MAGIC_NUMBER = b'\x89PNG\r\n\x1a\n'
         self.chunks = []
         self.chunks_count = {}
-        self.reconstructed_idat_data = []
-        self.after_iend_data = bytes()
-        self.bytesPerPixel = 0
+        # Index built during reading: chunk type -> positions (in self.chunks) of all chunks of this type
+        self.chunk_positions = {}
+        self.after_iend_data = memoryview(b'')
+        self.parser = None
+        # Pixels are reconstructed lazily, on the first access to reconstructed_idat_data or bytesPerPixel.
+        # reconstructed_idat_data is a numpy array of shape (height, width, bytesPerPixel)
+        self.pixels_loaded = False
+        self._reconstructed_idat_data = None
+        self._bytesPerPixel = 0
 
     def __del__(self):
         log.debug('Closing file')
+        # Memory map itself is not closed explicitly, because chunks may still hold slices of it.
+        # It is released together with the last of them.
         try:
             self.file.close()
         except AttributeError:
             pass
             
     
+    @property
+    def reconstructed_idat_data(self):
+        self.load_pixels()
+        return self._reconstructed_idat_data
+
+    @reconstructed_idat_data.setter
+    def reconstructed_idat_data(self, value):
+        self._reconstructed_idat_data = value
+
+    @property
+    def bytesPerPixel(self):
+        self.load_pixels()
+        return self._bytesPerPixel
+
+    @bytesPerPixel.setter
+    def bytesPerPixel(self, value):
+        self._bytesPerPixel = value
+
+    def load_pixels(self):
+        """Reconstruct pixels of parsed PNG, unless it has already been done
+
+        It is the expensive part of parsing (decompression, defiltering, pallette and gamma), so it is
+        postponed until some command really needs pixels.
+        """
+        if self.pixels_loaded:
+            return
+        assert self.parser is not None, "PNG must be parsed before its pixels are loaded"
+
+        # Flag is set upfront, because parser itself accesses reconstructed_idat_data while it is filling it
+        self.pixels_loaded = True
+        try:
+            self.parser.reconstruct_pixels()
+        except:
+            self.pixels_loaded = False
+            self._reconstructed_idat_data = None
+            raise
+
+    def get_grayscale_pixels(self):
+        """Convert reconstructed pixels to one grayscale channel. Alpha channel is ignored.
+
+        Colors are weighted in the same way as in ITU-R BT.601 (which is also used e.g. by OpenCV):
+        Y = 0.299 R + 0.587 G + 0.114 B
+
+        Returns:
+            np.ndarray: Array of shape (height, width). For greyscale images it is a view of reconstructed_idat_data.
+        """
+        pixels = self.reconstructed_idat_data
+        if self.bytesPerPixel <= 2:
+            return pixels[:, :, 0]
+        return np.rint(pixels[:, :, :3] @ np.array([0.299, 0.587, 0.114])).astype(pixels.dtype)
+
     def assert_existance(self, type_to_assert):
-        return True if any(chunk.type_ == type_to_assert for chunk in self.chunks) else False
+        return type_to_assert in self.chunk_positions
 
     def get_chunk_by_type(self, type_):
-        try:
-            return [chunk for chunk in self.chunks if chunk.type_ == type_][0]
-        except IndexError:
-            return None
+        positions = self.chunk_positions.get(type_)
+        return self.chunks[positions[0]] if positions else None
 
     def get_all_chunks_by_type(self, type_):
-        return [chunk for chunk in self.chunks if chunk.type_ == type_]
+        return [self.chunks[position] for position in self.chunk_positions.get(type_, [])]
+
+    def get_chunk_position(self, type_):
+        """Return position (in chunks list) of the first chunk of given type or None if there is no such chunk
+        """
+        positions = self.chunk_positions.get(type_)
+        return positions[0] if positions else None
 
-    def get_decompressed_idat_data(self):
-        IDAT_data = b''.join(chunk.data for chunk in self.get_all_chunks_by_type(b'IDAT'))
-        return zlib.decompress(IDAT_data)
+    @property
+    def first_idat_position(self):
+        return self.get_chunk_position(b'IDAT')
 
-    def print_chunks(self, get_idat_data, get_plte_data):
+    @property
+    def last_idat_position(self):
+        positions = self.chunk_positions.get(b'IDAT')
+        return positions[-1] if positions else None
+
+    def iter_decompressed_idat_data(self):
+        """Decompress IDAT chunks one by one, without joining them
+
+        Every yielded piece is at most DECOMPRESSION_PIECE_LEN long, so even small, highly compressed chunks
+        do not produce big buffers.
+
+        Yields:
+            bytes: Next piece of decompressed IDAT data
+        """
+        decompressor = zlib.decompressobj()
+        for chunk in self.get_all_chunks_by_type(b'IDAT'):
+            data = chunk.data
+            while data:
+                piece = decompressor.decompress(data, self.DECOMPRESSION_PIECE_LEN)
+                data = decompressor.unconsumed_tail
+                if piece:
+                    yield piece
+        piece = decompressor.flush()
+        if piece:
+            yield piece
+        assert decompressor.eof, "Image's IDAT data stream is incomplete. Corrupted image"
+
+    def iter_scanlines(self):
+        """Yield reconstructed scanlines of parsed image one by one, see PngParser.iter_scanlines
+        """
+        return self.parser.iter_scanlines()
+
+    def print_chunks(self, get_idat_data, get_plte_data, output=None):
         """
         Args:
             get_idat_data(bool): If set to true, IDAT data is printed to console
             get_plte_data(bool): If set to true, PLTE data is printed to console
+            output: Text stream. Defaults to sys.stdout.
         """
+        output = output or sys.stdout
         for i, chunk in enumerate(self.chunks, 1):
-            print(f"\033[1mCHUNK #{i}\033[0m")
-            # Default behavior is to enter if statements and replace data with empty strings
-            # Data in those chunks is generally long and makes chunk summary less readable
-            if isinstance(chunk, IDAT) and not get_idat_data:
-                with temporary_data_change(chunk, ''):
-                    print(chunk)
-                    continue
-            elif isinstance(chunk, PLTE) and not get_plte_data:
-                with temporary_data_change(chunk, ''):
-                    print(chunk)
-                    continue
-            print(chunk)
-        print("\033[4mChunks summary\033[0m:")
+            output.write(f"\033[1mCHUNK #{i}\033[0m\n")
+            chunk.write_description(output, self.should_print_data(chunk.type_, get_idat_data, get_plte_data))
+            output.write('\n')
+        output.write("\033[4mChunks summary\033[0m:\n")
         for key, value in self.chunks_count.items():
-            print(key.decode('utf-8'), ':', value)
+            output.write(f"{key.decode('utf-8')} : {value}\n")
+
+    def print_chunks_json(self, get_idat_data, get_plte_data, ndjson=False, output=None):
+        """Print chunks as JSON - every chunk is an object with its decoded fields (see Chunk.get_record)
+
+        Args:
+            get_idat_data(bool): If set to true, raw IDAT data is added to IDAT chunks
+            get_plte_data(bool): If set to true, raw PLTE data is added to PLTE chunk
+            ndjson(bool): If set to true, every chunk is printed as a separate line. Otherwise, a single object
+                          with file name, list of chunks and chunks summary is printed.
+            output: Text stream. Defaults to sys.stdout.
+        """
+        output = output or sys.stdout
+        if ndjson:
+            for chunk in self.chunks:
+                chunk.write_json(output, self.should_print_data(chunk.type_, get_idat_data, get_plte_data))
+                output.write('\n')
+            return
+
+        output.write(f'{{"file": {json.dumps(self.file.name)}, "chunks": [')
+        for i, chunk in enumerate(self.chunks):
+            if i:
+                output.write(', ')
+            chunk.write_json(output, self.should_print_data(chunk.type_, get_idat_data, get_plte_data))
+        chunks_count = {key.decode('utf-8', 'replace'): value for key, value in self.chunks_count.items()}
+        output.write(f'], "chunks_count": {json.dumps(chunks_count)}, "after_iend_data_len": {len(self.after_iend_data)}}}\n')
+
+    @staticmethod
+    def should_print_data(chunk_type, get_idat_data, get_plte_data):
+        # Data in IDAT and PLTE chunks is generally long and makes chunk summary less readable, so it is skipped by default
+        if chunk_type == b'IDAT':
+            return get_idat_data
+        if chunk_type == b'PLTE':
+            return get_plte_data
+        return True
+
+    def parse(self, no_gamma_mode, adam7_passes=7, verify_crc=False):
+        """Read and assert chunks. Pixels are reconstructed later, when they are needed - see load_pixels
+
+        Args:
+            no_gamma_mode(bool): Determines, whether gamma should be aplied (if exists)
+            adam7_passes(int): Number of Adam7 passes to decode, if image is interlaced. Less than 7 gives low-resolution preview.
+            verify_crc(bool): If set to true, CRC of every chunk is checked and parsing fails on the first corrupted chunk
+        """
+        self.parser = PngParser(self, no_gamma_mode, adam7_passes, verify_crc)
 
-    def parse(self, no_gamma_mode):
-        PngParser(self, no_gamma_mode)
+    def verify_crc(self, workers=None):
+        """Compute CRC of every chunk and compare it with the stored one
+
+        Args:
+            workers(int): Number of threads computing CRCs. Defaults to ThreadPoolExecutor default. With 1 no threads are used.
+
+        Returns:
+            list: (chunk, computed_crc, is_valid) tuple for every chunk, in order of appearance
+        """
+        if workers == 1 or len(self.chunks) == 1:
+            computed_crcs = [chunk.compute_crc() for chunk in self.chunks]
+        else:
+            with ThreadPoolExecutor(workers) as executor:
+                computed_crcs = list(executor.map(lambda chunk: chunk.compute_crc(), self.chunks))
+
+        return [(chunk, crc, crc == int.from_bytes(chunk.crc, 'big')) for chunk, crc in zip(self.chunks, computed_crcs)]
 
     def create_clean_copy(self, new_file_name):
         """Creates brand new file with ONLY critical chunks in it
+
+        Chunks are copied from the source file as raw byte ranges (see write_chunks), so IDAT data never goes through python.
+        New file is written atomically, thus new_file_name may also be the name of the source file (in-place cleaning).
+        """
+        ancilary_chunks = self.get_critical_chunk_types()
+        self.write_png([chunk for chunk in self.chunks if chunk.type_ in ancilary_chunks], new_file_name)
+
+    def get_critical_chunk_types(self):
+        """Return types of chunks, which are necessary to display the image
+        """
+        ancilary_chunks = [
+            b'IHDR',
+            b'IDAT',
+            b'IEND'
+        ]
+        if self.get_chunk_by_type(b'IHDR').color_type == 3:
+            ancilary_chunks.insert(1, b'PLTE')
+        return ancilary_chunks
+
+    def write_png(self, chunks, new_file_name):
+        """Atomically write PNG file consisting of given chunks
+
+        File is written under temporary name in the destination directory and then renamed, so readers never
+        see half-written file and the source file can be safely replaced.
+
+        Args:
+            chunks(list): Chunks to write. They may come from this PNG or be created from scratch.
+            new_file_name(str): Path of new file
+        """
+        directory = os.path.dirname(os.path.abspath(new_file_name))
+        temporary_fd, temporary_name = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(new_file_name)}.', suffix='.tmp')
+        try:
+            with os.fdopen(temporary_fd, 'wb', buffering=0) as file_handler:
+                file_handler.write(self.PNG_MAGIC_NUMBER)
+                self.write_chunks(chunks, file_handler)
+                replaces_source = os.path.exists(new_file_name) and os.path.samefile(new_file_name, self.file.name)
+                if replaces_source:
+                    # Original file is about to be replaced, so new one must really be on disk
+                    os.fsync(file_handler.fileno())
+            shutil.copymode(self.file.name, temporary_name)
+            os.replace(temporary_name, new_file_name)
+        except:
+            os.unlink(temporary_name)
+            raise
+
+    def write_chunks(self, chunks, file_handler):
+        """Write chunks to unbuffered binary file
+
+        Chunks that were read from this PNG file are copied directly from source file to destination file as byte ranges.
+        Neighbouring chunks are merged into a single range. Chunks created from scratch (without offset) are written field by field.
+
+        Args:
+            chunks(list): Chunks to write
+            file_handler: File opened with buffering=0, so writes and range copies go to the file in order
         """
-        def get_ancilary_chunks():
-            ancilary_chunks = [
-                b'IHDR',
-                b'IDAT',
-                b'IEND'
-            ]
-            if self.get_chunk_by_type(b'IHDR').color_type == 3:
-                ancilary_chunks.insert(1, b'PLTE')
-            return ancilary_chunks
-
-        ancilary_chunks = get_ancilary_chunks()
-        file_handler = open(new_file_name, 'wb')
-        file_handler.write(self.PNG_MAGIC_NUMBER)
-
-        for chunk in self.chunks:
-            if chunk.type_ in ancilary_chunks:
-                file_handler.write(chunk.length)
-                file_handler.write(chunk.type_)
-                file_handler.write(chunk.data)
-                file_handler.write(chunk.crc)
-
-        file_handler.close()
+        range_start = range_end = None
+        for chunk in chunks:
+            if chunk.offset is not None and isinstance(chunk.data, memoryview) and chunk.data.obj is self.buffer.obj:
+                chunk_end = chunk.offset + Chunk.LENGTH_FIELD_LEN + Chunk.TYPE_FIELD_LEN + len(chunk.data) + Chunk.CRC_FIELD_LEN
+                if chunk.offset == range_end:
+                    range_end = chunk_end
+                    continue
+                if range_start is not None:
+                    self.copy_byte_range(range_start, range_end, file_handler)
+                range_start, range_end = chunk.offset, chunk_end
+                continue
+
+            if range_start is not None:
+                self.copy_byte_range(range_start, range_end, file_handler)
+                range_start = range_end = None
+            chunk.write(file_handler)
+
+        if range_start is not None:
+            self.copy_byte_range(range_start, range_end, file_handler)
+
+    def copy_byte_range(self, start, end, file_handler):
+        """Copy bytes [start, end) of source file to the current position of destination file
+
+        Data is copied inside the kernel with copy_file_range (or sendfile, if the first one is not available).
+        If none of them works (e.g. on non-Linux systems), data is written from memory-mapped source file.
+        """
+        source_fd = self.file.fileno()
+        destination_fd = file_handler.fileno()
+        try:
+            while start < end:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(source_fd, destination_fd, end - start, start)
+                else:
+                    copied = os.sendfile(destination_fd, source_fd, start, end - start)
+                if copied == 0:
+                    raise OSError(f"Unexpected end of {self.file.name}")
+                start += copied
+        except (OSError, AttributeError):
+            log.debug("Kernel copy is not available, copying through memory")
+            while start < end:
+                start += file_handler.write(self.buffer[start:end])
+
+def print_record_json(file_name, record, get_idat_data, get_plte_data, ndjson=False, output=None):
+    """Print metadata record (see batch.metadata_file), e.g. taken from MetadataCache, just as Png.print_chunks_json prints parsed file
+
+    Record holds decoded fields of chunks, but not theirs data. Data of chunks, which are printed with data, is read
+    straight from file by chunk offsets - file is not parsed and CRCs are not computed.
+
+    Args:
+        file_name(str): Path of PNG file, which record describes
+        record(dict): Metadata record
+        get_idat_data(bool): If set to true, raw IDAT data is added to IDAT chunks
+        get_plte_data(bool): If set to true, raw PLTE data is added to PLTE chunk
+        ndjson(bool): If set to true, every chunk is printed as a separate line - see Png.print_chunks_json
+        output: Text stream. Defaults to sys.stdout.
+    """
+    output = output or sys.stdout
+    chunks_count = {}
+    with open(file_name, 'rb') as file_handler:
+        if not ndjson:
+            output.write(f'{{"file": {json.dumps(file_name)}, "chunks": [')
+        for i, chunk_record in enumerate(record['chunks']):
+            if i and not ndjson:
+                output.write(', ')
+            chunk_record = {key: value for key, value in chunk_record.items() if key != 'crc_valid'}
+            chunks_count[chunk_record['type']] = chunks_count.get(chunk_record['type'], 0) + 1
+            data = None
+            if Png.should_print_data(chunk_record['type'].encode('utf-8'), get_idat_data, get_plte_data):
+                file_handler.seek(chunk_record['offset'] + Chunk.LENGTH_FIELD_LEN + Chunk.TYPE_FIELD_LEN)
+                data = file_handler.read(chunk_record['length'])
+            Chunk.write_record_json(output, chunk_record, data)
+            if ndjson:
+                output.write('\n')
+    if not ndjson:
+        output.write(f'], "chunks_count": {json.dumps(chunks_count)}, "after_iend_data_len": {record["after_iend_data_len"]}}}\n')
+
+def clean_files(file_names, output_dir=None, in_place=False):
+    """Create clean copies (see Png.create_clean_copy) of many files
+
+    Args:
+        file_names(list): Paths of PNG files
+        output_dir(str): Directory, where clean copies are written (with the same names as original files)
+        in_place(bool): If set to true, every file is replaced with its clean copy and output_dir is ignored
+
+    Returns:
+        list: Paths of created files
+    """
+    assert in_place or output_dir, "Either output_dir or in_place must be set"
+    created_files = []
+    for file_name in file_names:
+        png = Png(file_name)
+        png.parse(True)
+        new_file_name = file_name if in_place else os.path.join(output_dir, os.path.basename(file_name))
+        log.info(f"Cleaning '{file_name}' -> '{new_file_name}'")
+        png.create_clean_copy(new_file_name)
+        created_files.append(new_file_name)
+    return created_files
+
+def verify_files(file_names, workers=None):
+    """Verify CRCs (see Png.verify_crc) of many files at once
+
+    Files are verified in parallel threads. Single file is verified chunk by chunk in parallel.
+    Every file is handled separately, so broken file does not stop verification of the others.
+
+    Args:
+        file_names(list): Paths of PNG files
+        workers(int): Number of threads. Defaults to ThreadPoolExecutor default.
+
+    Returns:
+        tuple: (results, bytes_verified, elapsed_seconds). results is a list of (file_name, chunk_results, error) tuples,
+               where chunk_results is returned by Png.verify_crc and error is a message of exception raised by broken file.
+    """
+    def verify_file(file_name, chunk_workers):
+        try:
+            png = Png(file_name)
+            png.parse(True)
+            return file_name, png.verify_crc(chunk_workers), None
+        except Exception as e:
+            return file_name, [], str(e)
+
+    start_time = time.perf_counter()
+    if len(file_names) == 1:
+        results = [verify_file(file_names[0], workers)]
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(lambda file_name: verify_file(file_name, 1), file_names))
+    elapsed = time.perf_counter() - start_time
+
+    bytes_verified = sum(len(chunk.type_) + len(chunk.data) for _, chunk_results, _ in results for chunk, _, _ in chunk_results)
+    return results, bytes_verified, elapsed
@@ -1,87 +1,338 @@
 import logging
 import zlib
 import math
-from chunks import CHUNKTYPES, Chunk, IHDR, IDAT, PLTE, temporary_data_change
+from functools import lru_cache
+from chunks import CHUNKTYPES, Chunk, IHDR
+from filters import iter_defilter, iter_defilter_images
+from lazyimport import lazy_import
+
+np = lazy_import('numpy')
 
 log = logging.getLogger(__name__)
 
+@lru_cache(maxsize=32)
+def get_gamma_table(gamma, bit_depth):
+    """Return look-up table with gamma corrected value for every possible sample value
+
+    Gamma correction depends only on gamma and bit depth, so there are at most 2^16 different inputs.
+    Tables are memoized, thus images with the same gAMA value share them.
+
+    Steps to apply gamma:
+    1. Normalize pixels from [0, max_colors_in_sample] to [0, 1.0]
+    2. Aplly gamma via equation: output = input ^ (1 / gamma)
+    3. Reverse normalize output to [0, max_colors_in_sample]
+    4. Finally do: floor(output + 0.5)
+    https://www.w3.org/TR/2003/REC-PNG-20031110/#13Decoder-gamma-handling
+
+    Args:
+        gamma(float): Value of gAMA chunk
+        bit_depth(int): Bit depth of samples
+
+    Returns:
+        np.ndarray: Read-only array of length 2^bit_depth
+    """
+    # This is basically the definition of bith depth.
+    # 2^bit_depth - 1 -> 255 for 8-bit | 31 for 5-bit etc.
+    max_colors_in_sample = 2 ** bit_depth - 1
+    invGamma = 1.0 / gamma
+
+    table = np.array([math.floor((((sample / max_colors_in_sample) ** invGamma) * max_colors_in_sample) + 0.5)
+                        for sample in range(max_colors_in_sample + 1)], dtype=np.uint16 if bit_depth > 8 else np.uint8)
+    # Table is shared between images, so it must not be modified
+    table.flags.writeable = False
+    return table
+
+def unpack_samples(scanlines, width, samples_per_pixel, bit_depth):
+    """Convert reconstructed scanlines to array of samples
+
+    - 8-bit samples are only reshaped, so returned array is a view of scanlines
+    - 16-bit samples are stored in big-endian order, they are converted to native uint16
+    - 1, 2 and 4-bit samples are packed into bytes (leftmost pixel in high-order bits), they are unpacked to uint8
+      by vectorized bit shifts. Bits padding the end of every scanline are dropped.
+
+    Args:
+        scanlines(np.ndarray): uint8 array of shape (height, stride)
+        width(int): Image width
+        samples_per_pixel(int): Number of samples in pixel
+        bit_depth(int): Number of bits per sample
+
+    Returns:
+        np.ndarray: Array of shape (height, width, samples_per_pixel), uint16 for 16-bit images, uint8 otherwise
+    """
+    height = scanlines.shape[0]
+    if bit_depth == 8:
+        return scanlines.reshape(height, width, samples_per_pixel)
+    if bit_depth == 16:
+        return scanlines.view('>u2').astype(np.uint16).reshape(height, width, samples_per_pixel)
+
+    # Sub-byte depths are allowed only for greyscale and indexed images, which have single sample per pixel
+    if bit_depth == 1:
+        samples = np.unpackbits(scanlines, axis=1)
+    else:
+        shifts = np.arange(8 - bit_depth, -1, -bit_depth, dtype=np.uint8)
+        samples = ((scanlines[:, :, np.newaxis] >> shifts) & (2 ** bit_depth - 1)).reshape(height, -1)
+    return np.ascontiguousarray(samples[:, :width]).reshape(height, width, 1)
+
 class PngParser:
     """Parse PNG
 
-    PNG is read, asserted, and its data is distributed among Chunk based objects.
-    Next up, IDAT chunk is processed. If there is a PLTE chunk, pallette is also aplied.
-    Finally gamma normalization is aplied if gAMA chunk is present.
+    Parsing is done in two stages:
+    1. During initialization PNG is read, asserted, and its data is distributed among Chunk based objects.
+       It is cheap and it is everything that commands working only with chunks (e.g. metadata) need.
+    2. Pixels are reconstructed only on demand, by reconstruct_pixels. IDAT chunk is processed. If there is a PLTE chunk,
+       pallette is also aplied. Finally gamma normalization is aplied if gAMA chunk is present.
     """
-    def __init__(self, png, no_gamma_mode):
+    # Number of samples within the pixel. E.g. RGB (type 2) has three samples -> (R, G, B)
+    # RGBA (type 6) has four samples -> (R, G, B, A). For 8-bit images it is also a number of bytes per pixel.
+    COLOR_TYPE_TO_SAMPLES_PER_PIXEL = {
+        0: 1,
+        2: 3,
+        3: 1,
+        4: 2,
+        6: 4
+    }
+
+    # Adam7 passes: (x_start, y_start, x_step, y_step, block_width, block_height)
+    # Block is the area that a pixel of given pass represents, when image is displayed progressively
+    # https://www.w3.org/TR/2003/REC-PNG-20031110/#8Interlace
+    ADAM7_PASSES = [
+        (0, 0, 8, 8, 8, 8),
+        (4, 0, 8, 8, 4, 8),
+        (0, 4, 4, 8, 4, 4),
+        (2, 0, 4, 4, 2, 4),
+        (0, 2, 2, 4, 2, 2),
+        (1, 0, 2, 2, 1, 2),
+        (0, 1, 1, 2, 1, 1),
+    ]
+
+    def __init__(self, png, no_gamma_mode, adam7_passes=7, verify_crc=False):
+        """
+        Args:
+            png(Png): Png object to be filled
+            no_gamma_mode(bool): Determines, whether gamma should be aplied (if exists)
+            adam7_passes(int): For interlaced images only first adam7_passes passes are decoded. With less than 7 passes
+                               every decoded pixel is replicated over its block, which gives a cheap, low-resolution preview.
+            verify_crc(bool): Check CRC of every chunk right after chunks are read
+        """
         self.png = png
+        self.no_gamma_mode = no_gamma_mode
+        assert 1 <= adam7_passes <= len(self.ADAM7_PASSES), f"Number of Adam7 passes must be between 1 and {len(self.ADAM7_PASSES)}"
+        self.adam7_passes = adam7_passes
         log.debug('Checking signature')
-        if png.file.read(len(png.PNG_MAGIC_NUMBER)) != png.PNG_MAGIC_NUMBER:
+        if png.buffer[:len(png.PNG_MAGIC_NUMBER)] != png.PNG_MAGIC_NUMBER:
             raise Exception(f'{png.file.name} is not a PNG!')
 
         self.read_chunks()
+        if verify_crc:
+            self.assert_crc()
         self.assert_png()
+
+    def reconstruct_pixels(self):
+        """Second stage of parsing - decode pixels of already read and asserted PNG
+        """
         self.process_idat_data()
-        if self.png.assert_existance(b'PLTE'):
+        # For truecolor images PLTE is only a suggestion, pixels are not indexed
+        if self.png.get_chunk_by_type(b'IHDR').color_type == 3:
             self.apply_pallette()
-        if self.png.assert_existance(b'gAMA') and not no_gamma_mode:
+        if self.png.assert_existance(b'gAMA') and not self.no_gamma_mode:
             if self.png.get_chunk_by_type(b'gAMA').gamma == 0:
                 log.warning("Skipping gamma normalization because gamma have value 0!")
             else:
                 self.apply_gamma()
 
     def read_chunks(self):
+        """Index chunks of memory-mapped file
+
+        Only chunk headers are read. Every chunk remembers its offset and gets its data as a memoryview slice
+        of the file, so no data is copied. Everything after IEND is also exposed as a single slice.
+        """
         log.debug('Reading Chunks')
+        buffer = self.png.buffer
+        offset = len(self.png.PNG_MAGIC_NUMBER)
+        header_len = Chunk.LENGTH_FIELD_LEN + Chunk.TYPE_FIELD_LEN
         while True:
-            length = self.png.file.read(Chunk.LENGTH_FIELD_LEN)
-            # If length is empty, we have reached and of the file
-            type_ = self.png.file.read(Chunk.TYPE_FIELD_LEN)
-            data = self.png.file.read(int.from_bytes(length, 'big'))
-            crc = self.png.file.read(Chunk.CRC_FIELD_LEN)
+            if offset + header_len + Chunk.CRC_FIELD_LEN > len(buffer):
+                raise Exception(f'{self.png.file.name} is truncated. IEND chunk has not been found')
+
+            length = bytes(buffer[offset : offset + Chunk.LENGTH_FIELD_LEN])
+            type_ = bytes(buffer[offset + Chunk.LENGTH_FIELD_LEN : offset + header_len])
+            data_start = offset + header_len
+            data_end = data_start + int.from_bytes(length, 'big')
+            if data_end + Chunk.CRC_FIELD_LEN > len(buffer):
+                raise Exception(f'{self.png.file.name} is truncated. {type_} chunk is incomplete')
+            data = buffer[data_start : data_end]
+            crc = bytes(buffer[data_end : data_end + Chunk.CRC_FIELD_LEN])
 
             # Initialize new chunk with class that CHUNKTYPES is pointing to. If new chunk
             # is not mentioned in CHUNKTYPES, Chunk base class is initialized.
             chunk_class_type = CHUNKTYPES.get(type_, Chunk)
-            chunk = chunk_class_type(length, type_, data, crc)
+            chunk = chunk_class_type(length, type_, data, crc, offset)
 
+            self.png.chunk_positions.setdefault(type_, []).append(len(self.png.chunks))
             self.png.chunks.append(chunk)
             self.png.chunks_count[type_] = self.png.chunks_count.get(type_, 0) + 1
+            offset = data_end + Chunk.CRC_FIELD_LEN
             if type_ == b"IEND":
                 break
 
-        while True:
-            bytes_read = self.png.file.read(2)
-            if not bytes_read:
-                break
-            self.png.after_iend_data += bytes_read
+        self.png.after_iend_data = buffer[offset:]
 
     def process_idat_data(self):
-        """Decompress and defilter IDAT data
+        """Decompress, defilter IDAT data and unpack samples
 
-        This method is taken from this tutorial:
+        Defiltering is based on this tutorial:
         https://pyokagan.name/blog/2019-10-14-png/
         Solid explanation is also available there.
         """
         log.debug('Proccessing IDAT')
-        # Byte per pixel is a measure of chunks within the pixel. E.g. RGB (type 2) has three chunks -> (R, G, B)
-        # RGBA (type 6) has four chunks -> (R, G, B, A).
-        color_type_to_bytes_per_pixel_ratio = {
-            0: 1,
-            2: 3,
-            3: 1,
-            4: 2,
-            6: 4
-        }
-
-        # DECOMPRESSING
-        IDAT_data = self.png.get_decompressed_idat_data()
-
-        self.png.bytesPerPixel = color_type_to_bytes_per_pixel_ratio.get(self.png.get_chunk_by_type(b'IHDR').color_type)
-        width = self.png.get_chunk_by_type(b'IHDR').width
-        height = self.png.get_chunk_by_type(b'IHDR').height
-        expected_IDAT_data_len = height * (1 + width * self.png.bytesPerPixel)
-
-        assert expected_IDAT_data_len == len(IDAT_data), "Image's decompressed IDAT data is not as expected. Corrupted image"
-        stride = width * self.png.bytesPerPixel
+        ihdr_chunk = self.png.get_chunk_by_type(b'IHDR')
+        self.png.bytesPerPixel = self.COLOR_TYPE_TO_SAMPLES_PER_PIXEL.get(ihdr_chunk.color_type)
+        if ihdr_chunk.interlace_method == 1:
+            self.png.reconstructed_idat_data = self.process_interlaced_idat_data()
+            return
+
+        stride, _ = self.get_scanline_geometry(ihdr_chunk.width)
+        scanlines = np.empty((ihdr_chunk.height, stride), dtype=np.uint8)
+
+        # DECOMPRESSING AND DEFILTERING
+        # Scanlines are reconstructed as soon as enough IDAT data is decompressed, so whole decompressed stream is never kept in memory
+        for r, scanline in enumerate(self.iter_scanlines()):
+            scanlines[r] = scanline
+
+        # Pixels are stored in a contiguous array of shape (height, width, samples)
+        self.png.reconstructed_idat_data = unpack_samples(scanlines, ihdr_chunk.width, self.png.bytesPerPixel, ihdr_chunk.bit_depth)
+
+    def process_interlaced_idat_data(self):
+        """Decode Adam7 interlaced image
+
+        Every pass is a separate sub-image. It is defiltered and unpacked in the same way as non-interlaced image
+        and then scattered into the final image with a single strided assignment.
+
+        Returns:
+            np.ndarray: Array of shape (height, width, samples)
+        """
+        ihdr_chunk = self.png.get_chunk_by_type(b'IHDR')
+        pixels = np.zeros((ihdr_chunk.height, ihdr_chunk.width, self.png.bytesPerPixel),
+                            dtype=np.uint16 if ihdr_chunk.bit_depth == 16 else np.uint8)
+        preview = self.adam7_passes < len(self.ADAM7_PASSES)
+        scanlines = self.iter_scanlines()
+
+        for pass_number, pass_width, pass_height in self.get_adam7_passes():
+            if pass_number >= self.adam7_passes:
+                # Remaining passes are not even decompressed
+                break
+            x_start, y_start, x_step, y_step, block_width, block_height = self.ADAM7_PASSES[pass_number]
+            stride, _ = self.get_scanline_geometry(pass_width)
+
+            pass_scanlines = np.empty((pass_height, stride), dtype=np.uint8)
+            for r in range(pass_height):
+                pass_scanlines[r] = next(scanlines)
+            pass_pixels = unpack_samples(pass_scanlines, pass_width, self.png.bytesPerPixel, ihdr_chunk.bit_depth)
+
+            if not preview:
+                pixels[y_start::y_step, x_start::x_step] = pass_pixels
+                continue
+            # In preview mode pixel fills its whole block. Later passes overwrite parts of blocks of earlier ones.
+            for y_offset in range(min(block_height, ihdr_chunk.height - y_start)):
+                for x_offset in range(min(block_width, ihdr_chunk.width - x_start)):
+                    target = pixels[y_start + y_offset::y_step, x_start + x_offset::x_step]
+                    target[...] = pass_pixels[:target.shape[0], :target.shape[1]]
+
+        if not preview:
+            # Exhausting the generator makes it check that there is no data after the last pass
+            assert next(scanlines, None) is None, "Image's decompressed IDAT data is longer than expected. Corrupted image"
+        return pixels
+
+    def get_raw_images(self):
+        """Decompress and defilter IDAT data, but do not unpack samples
+
+        Returns:
+            list: (scanlines, bytes_per_pixel) pair of every image stored in IDAT - the whole image or every Adam7 pass
+                  for interlaced images. scanlines is uint8 array of shape (height, stride).
+        """
+        ihdr_chunk = self.png.get_chunk_by_type(b'IHDR')
+        if ihdr_chunk.interlace_method == 0:
+            sizes = [(ihdr_chunk.width, ihdr_chunk.height)]
+        else:
+            sizes = [(pass_width, pass_height) for _, pass_width, pass_height in self.get_adam7_passes()]
+
+        scanlines_iterator = self.iter_scanlines()
+        images = []
+        for width, height in sizes:
+            stride, bytes_per_pixel = self.get_scanline_geometry(width)
+            scanlines = np.empty((height, stride), dtype=np.uint8)
+            for r in range(height):
+                scanlines[r] = next(scanlines_iterator)
+            images.append((scanlines, bytes_per_pixel))
+        return images
+
+    def get_adam7_passes(self):
+        """Compute size of every Adam7 pass
+
+        Returns:
+            list: (pass_number, width, height) of every pass. Pass numbers start with 0.
+                  Passes which are empty for the image size are skipped, because they are not stored in IDAT.
+        """
+        ihdr_chunk = self.png.get_chunk_by_type(b'IHDR')
+        passes = []
+        for pass_number, (x_start, y_start, x_step, y_step, _, _) in enumerate(self.ADAM7_PASSES):
+            pass_width = (ihdr_chunk.width - x_start + x_step - 1) // x_step
+            pass_height = (ihdr_chunk.height - y_start + y_step - 1) // y_step
+            if pass_width > 0 and pass_height > 0:
+                passes.append((pass_number, pass_width, pass_height))
+        return passes
+
+    def get_scanline_geometry(self, width):
+        """Compute size of scanline in bytes
+
+        Args:
+            width(int): Number of pixels in scanline
+
+        Returns:
+            tuple: (stride, bytes_per_pixel). Stride is length of scanline in bytes (without filter type byte).
+                   bytes_per_pixel is a distance used by filters - for bit depths lower than 8 it is rounded up to 1.
+        """
+        ihdr_chunk = self.png.get_chunk_by_type(b'IHDR')
+        bits_per_pixel = self.COLOR_TYPE_TO_SAMPLES_PER_PIXEL.get(ihdr_chunk.color_type) * ihdr_chunk.bit_depth
+
+        return (width * bits_per_pixel + 7) // 8, max(1, bits_per_pixel // 8)
+
+    def iter_scanlines(self):
+        """Decompress and defilter IDAT data on the fly
+
+        IDAT chunks are decompressed one by one and every scanline is yielded right after it is reconstructed.
+        Only the previous scanline is kept, so it can be used to process images row by row in bounded memory.
+        For interlaced images scanlines of Adam7 passes are yielded pass after pass - see get_adam7_passes.
+
+        Yields:
+            np.ndarray: uint8 array with reconstructed (but still packed) scanline
+        """
+        ihdr_chunk = self.png.get_chunk_by_type(b'IHDR')
+        stride, bytes_per_pixel = self.get_scanline_geometry(ihdr_chunk.width)
+        if ihdr_chunk.interlace_method == 0:
+            return iter_defilter(self.png.iter_decompressed_idat_data(), ihdr_chunk.height, stride, bytes_per_pixel)
+
+        images = [(pass_height, self.get_scanline_geometry(pass_width)[0]) for _, pass_width, pass_height in self.get_adam7_passes()]
+        return iter_defilter_images(self.png.iter_decompressed_idat_data(), images, bytes_per_pixel)
+
+    @staticmethod
+    def reference_defilter(IDAT_data, height, stride, bytes_per_pixel):
+        """Reconstruct IDAT data byte by byte, using plain python
+
+        It is the original, straightforward implementation of defiltering. It is way too slow to be used for real images,
+        but it is kept as a reference that output of filters.iter_defilter is compared with (see tests/test_filters.py).
+        Taken from: https://pyokagan.name/blog/2019-10-14-png/
+
+        Args:
+            IDAT_data(bytes): Decompressed IDAT data
+            height(int): Image height
+            stride(int): Length of scanline in bytes (without filter type byte)
+            bytes_per_pixel(int): Distance (in bytes) to the corresponding byte of the pixel on the left
+
+        Returns:
+            list: Reconstructed bytes
+        """
+        reconstructed_idat_data = []
 
         # DEFINING DEFILTER FUNCTIONS
         def paeth_predictor(a, b, c):
@@ -98,13 +349,13 @@ class PngParser:
             return Pr
 
         def recon_a(r, c):
-            return self.png.reconstructed_idat_data[r * stride + c - self.png.bytesPerPixel] if c >= self.png.bytesPerPixel else 0
+            return reconstructed_idat_data[r * stride + c - bytes_per_pixel] if c >= bytes_per_pixel else 0
 
         def recon_b(r, c):
-            return self.png.reconstructed_idat_data[(r-1) * stride + c] if r > 0 else 0
+            return reconstructed_idat_data[(r-1) * stride + c] if r > 0 else 0
 
         def recon_c(r, c):
-            return self.png.reconstructed_idat_data[(r-1) * stride + c - self.png.bytesPerPixel] if r > 0 and c >= self.png.bytesPerPixel else 0
+            return reconstructed_idat_data[(r-1) * stride + c - bytes_per_pixel] if r > 0 and c >= bytes_per_pixel else 0
 
         # DEFILTER
         i = 0
@@ -126,7 +377,17 @@ class PngParser:
                     recon_x = filt_x + paeth_predictor(recon_a(r, c), recon_b(r, c), recon_c(r, c))
                 else:
                     raise Exception('unknown filter type: ' + str(filter_type))
-                self.png.reconstructed_idat_data.append(recon_x & 0xff) # truncation to byte
+                reconstructed_idat_data.append(recon_x & 0xff) # truncation to byte
+
+        return reconstructed_idat_data
+
+    def assert_crc(self):
+        """Assert, that every chunk has valid CRC. It is done before other assertions, because corrupted data would make them misleading.
+        """
+        log.debug('Asserting CRC')
+        for i, (chunk, computed_crc, is_valid) in enumerate(self.png.verify_crc(), 1):
+            assert is_valid, (f"CRC of chunk #{i} ({chunk.type_.decode('utf-8', 'replace')}) is not valid: "
+                                f"stored {chunk.crc.hex()}, computed {computed_crc:08x}. Corrupted image")
 
     def assert_png(self):
         """ Asserts PNG data according to PNG specification
@@ -137,7 +398,9 @@ class PngParser:
         """
         log.debug('Asserting PNG data')
         ihdr_chunk = self.png.get_chunk_by_type(b'IHDR')
-        first_idat_occurence = min(idx for idx, val in enumerate(self.png.chunks) if isinstance(val, IDAT))
+        # Positions of chunks are taken from the index built by read_chunks, so no assertion needs to scan chunks list
+        first_idat_occurence = self.png.first_idat_position
+        assert first_idat_occurence is not None, "There is no IDAT chunk"
 
         def assert_ihdr():
             log.debug('Assert IHDR')
@@ -160,17 +423,15 @@ class PngParser:
                                     )
             assert ihdr_chunk.compression_method == 0, f"Unsupported compression_method: {ihdr_chunk.compression_method}. Only 0 is supported."
             assert ihdr_chunk.filter_method == 0, f"Unsupported filter_method: {ihdr_chunk.filter_method}. Only 0 is supported."
-            # We do not support Adam7 interlace
-            assert ihdr_chunk.interlace_method == 0, f"Unsupported interlace_method: {ihdr_chunk.interlace_method}. Only 0 is supported."
+            assert ihdr_chunk.interlace_method in [0, 1], f"Unsupported interlace_method: {ihdr_chunk.interlace_method}. It must be one of: 0 (none), 1 (Adam7)"
 
         def assert_idat():
             log.debug('Assert IDAT')
             assert self.png.chunks_count.get(b'IDAT'), f"Incorrect number of IDAT chunks: {self.png.chunks_count.get(b'IDAT')}"
 
-            last_idat_occurence = max(idx for idx, val in enumerate(self.png.chunks) if isinstance(val, IDAT))
-            only_idat_interval = self.png.chunks[first_idat_occurence : last_idat_occurence + 1]
-
-            assert all(isinstance(obj, IDAT) for obj in only_idat_interval), "IDAT chunks must be consecutive!"
+            last_idat_occurence = self.png.last_idat_position
+            # IDAT chunks are consecutive only if there is no other chunk between the first and the last one
+            assert last_idat_occurence - first_idat_occurence + 1 == self.png.chunks_count.get(b'IDAT'), "IDAT chunks must be consecutive!"
 
         def assert_plte():
             plte_chunks_number = self.png.chunks_count.get(b'PLTE')
@@ -182,17 +443,32 @@ class PngParser:
                 assert ihdr_chunk.color_type == 2 or ihdr_chunk.color_type == 6, f"PLTE chunk must not appear for color type {ihdr_chunk.color_type}!"
 
             plte_chunk = self.png.get_chunk_by_type(b'PLTE')
-            plte_index = self.png.chunks.index(plte_chunk)
+            plte_index = self.png.get_chunk_position(b'PLTE')
 
             assert plte_chunks_number == 1, f"Incorrect number of PLTE chunks: {plte_chunks_number}!"
             assert first_idat_occurence > plte_index, "PLTE must be placed before IDAT!"
-            assert len(plte_chunk.get_parsed_data()) <= 2 ** ihdr_chunk.bit_depth, "Number of pallette entries shall not exceed 2^bit_depth!"
             assert int.from_bytes(plte_chunk.length, 'big') % 3 == 0, "PLTE chunk length is not divisible by 3!"
+            assert plte_chunk.get_entries_count() <= 2 ** ihdr_chunk.bit_depth, "Number of pallette entries shall not exceed 2^bit_depth!"
+
+        def assert_trns():
+            trns_chunks_number = self.png.chunks_count.get(b'tRNS')
+            if not trns_chunks_number:
+                return
+
+            log.debug('Assert tRNS')
+            assert trns_chunks_number == 1, f"Incorrect number of tRNS chunks: {trns_chunks_number}"
+            assert ihdr_chunk.color_type in [0, 2, 3], f"tRNS chunk must not appear for color type {ihdr_chunk.color_type}!"
+            trns_index = self.png.get_chunk_position(b'tRNS')
+            assert first_idat_occurence > trns_index, "tRNS must be placed before IDAT!"
+            if ihdr_chunk.color_type == 3:
+                assert self.png.assert_existance(b'PLTE') and self.png.get_chunk_position(b'PLTE') < trns_index, "tRNS must be placed after PLTE!"
+                assert len(self.png.get_chunk_by_type(b'tRNS').data) <= self.png.get_chunk_by_type(b'PLTE').get_entries_count(), (
+                                    "tRNS chunk must not contain more alpha values than there are pallette entries!")
 
         def assert_iend():
             log.debug('Assert IEND')
             assert self.png.chunks_count.get(b'IEND') == 1, f"Incorrect number of IEND chunks: {self.png.chunks_count.get(b'IEND')}"
-            assert self.png.chunks[-1].type_ == b'IEND', "IEND must be the last chunk"
+            assert self.png.get_chunk_position(b'IEND') == len(self.png.chunks) - 1, "IEND must be the last chunk"
             assert len(self.png.get_chunk_by_type(b'IEND').data) == 0, "IEND chunk must be empty"
 
         def assert_time():
@@ -209,13 +485,12 @@ class PngParser:
                 return
 
             log.debug('Assert gAMA')
-            gama_chunk = self.png.get_chunk_by_type(b'gAMA')
-            gama_index = self.png.chunks.index(gama_chunk)
+            gama_index = self.png.get_chunk_position(b'gAMA')
 
             assert gama_chunks_number == 1, f"Incorrect number of gAMA chunks: {gama_chunks_number}"
             assert first_idat_occurence > gama_index, "gAMA must be placed before IDAT!"
             if self.png.assert_existance(b'PLTE'):
-                assert self.png.chunks.index(self.get_chunk_by_type(b'PLTE')) > gama_index, "gAMA must be placed before PLTE!"
+                assert self.png.get_chunk_position(b'PLTE') > gama_index, "gAMA must be placed before PLTE!"
 
         def assert_chrm():
             chrm_chunks_number = self.png.chunks_count.get(b'cHRM')
@@ -223,49 +498,51 @@ class PngParser:
                 return
 
             log.debug('Assert cHRM')
-            chrm_chunk = self.png.get_chunk_by_type(b'cHRM')
-            chrm_index = self.png.chunks.index(chrm_chunk)
+            chrm_index = self.png.get_chunk_position(b'cHRM')
 
             assert chrm_chunks_number == 1, f"Incorrect number of cHRM chunks: {chrm_chunks_number}"
             assert first_idat_occurence > chrm_index, "cHRM must be placed before IDAT!"
             if self.png.assert_existance(b'PLTE'):
-                assert self.png.chunks.index(self.png.get_chunk_by_type(b'PLTE')) > chrm_index, "cHRM must be placed before PLTE!"
+                assert self.png.get_chunk_position(b'PLTE') > chrm_index, "cHRM must be placed before PLTE!"
 
         assert_ihdr()
         assert_chrm()
         assert_gama()
         assert_plte()
+        assert_trns()
         assert_idat()
         assert_iend()
         assert_time()
 
     def apply_pallette(self):
-        """Replace indexed pixels in parsed IDAT with according pallette RGB values
+        """Replace indexed pixels in parsed IDAT with according pallette RGB(A) values
+
+        Pallette is used as a look-up table, so the whole image is expanded by a single vectorized indexing.
+        If tRNS chunk is present, its alpha values are merged into the pallette and image becomes RGBA.
         """
         log.debug('Applaying pallette')
-        pallette = self.png.get_chunk_by_type(b'PLTE').get_parsed_data()
-        # In next step: take indexed_pixel (index of pallette entry) from parsed IDAT. Find pallette entry which has this list index, and replace them.
+        pallette = self.png.get_chunk_by_type(b'PLTE').get_pallette_array()
+        trns_chunk = self.png.get_chunk_by_type(b'tRNS')
+        if trns_chunk is not None:
+            pallette = np.column_stack((pallette, trns_chunk.get_pallette_alpha(len(pallette))))
+
+        # In next step: take indexed_pixel (index of pallette entry) from parsed IDAT. Find pallette entry which has this index, and replace them.
         # If still confused -> please google how indexed colors work
-        self.png.reconstructed_idat_data = [pixel for indexed_pixel in self.png.reconstructed_idat_data for pixel in pallette[indexed_pixel]]
+        self.png.reconstructed_idat_data = pallette[self.png.reconstructed_idat_data[:, :, 0]]
 
-        # apply_pallette replaced indexed pixels in reconstructed_idat_data with corresponding RGB pixels, thus number of bytes per pixel has increased from 1 to 3
-        self.png.bytesPerPixel = 3
+        # apply_pallette replaced indexed pixels in reconstructed_idat_data with corresponding RGB(A) pixels, thus number of bytes per pixel has increased from 1 to 3 (or 4)
+        self.png.bytesPerPixel = pallette.shape[1]
 
     def apply_gamma(self):
         """Apply gamma normalization, to parsed IDAT pixels
+
+        Every sample is replaced with its value from precomputed gamma table - see get_gamma_table.
         """
         log.debug('Applying gamma normalization')
         gamma = self.png.get_chunk_by_type(b'gAMA').gamma
+        ihdr_chunk = self.png.get_chunk_by_type(b'IHDR')
+        # Bit depth of indexed image is a depth of pallette indices. Pixels are already replaced with 8-bit pallette entries.
+        bit_depth = 8 if ihdr_chunk.color_type == 3 else ihdr_chunk.bit_depth
+        gamma_table = get_gamma_table(gamma, bit_depth)
 
-        # This is basically the definition of bith depth.
-        # 2^bit_depth - 1 -> 255 for 8-bit | 31 for 5-bit etc.
-        max_colors_in_sample = 2 ** self.png.get_chunk_by_type(b'IHDR').bit_depth - 1
-        invGamma = 1.0 / gamma
-
-        # Steps to apply gamma:
-        # 1. Normalize pixels from [0, max_colors_in_sample] to [0, 1.0]
-        # 2. Aplly gamma via equation: output = input ^ (1 / gamma)
-        # 3. Reverse normalize output to [0, max_colors_in_sample]
-        # 4. Finally do: floor(output + 0.5)
-        # https://www.w3.org/TR/2003/REC-PNG-20031110/#13Decoder-gamma-handling
-        self.png.reconstructed_idat_data = [math.floor((((pixel / max_colors_in_sample) ** invGamma) * max_colors_in_sample) + 0.5) for pixel in self.png.reconstructed_idat_data]
+        self.png.reconstructed_idat_data = gamma_table[self.png.reconstructed_idat_data]
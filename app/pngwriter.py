@@ -0,0 +1,209 @@
+import logging
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from chunks import create_chunk
+from filters import ADAPTIVE_FILTER_STRATEGY, BRUTE_FORCE_FILTER_STRATEGY, FILTER_TYPES, filter_all_scanlines, filter_scanlines
+from lazyimport import lazy_import
+
+np = lazy_import('numpy')
+
+log = logging.getLogger(__name__)
+
+def pack_samples(pixels, bit_depth):
+    """Convert array of samples to scanlines of bytes. It is the reverse of pngparser.unpack_samples.
+
+    Args:
+        pixels(np.ndarray): Array of shape (height, width, samples_per_pixel)
+        bit_depth(int): Number of bits per sample
+
+    Returns:
+        np.ndarray: uint8 array of shape (height, stride)
+    """
+    height = pixels.shape[0]
+    if bit_depth == 8:
+        return np.ascontiguousarray(pixels, dtype=np.uint8).reshape(height, -1)
+    if bit_depth == 16:
+        return pixels.astype('>u2').view(np.uint8).reshape(height, -1)
+
+    # Sub-byte depths are allowed only for single sample pixels. Scanline is padded with zero bits up to full byte.
+    samples = pixels.reshape(height, -1).astype(np.uint8)
+    samples_per_byte = 8 // bit_depth
+    padding = -samples.shape[1] % samples_per_byte
+    samples = np.pad(samples, ((0, 0), (0, padding)))
+    if bit_depth == 1:
+        return np.packbits(samples, axis=1)
+    shifts = np.arange(8 - bit_depth, -1, -bit_depth, dtype=np.uint8)
+    return np.bitwise_or.reduce(samples.reshape(height, -1, samples_per_byte) << shifts, axis=2).astype(np.uint8)
+
+class PngWriter:
+    """Encode pixels to PNG file
+
+    Pixels are filtered with vectorized numpy operations (see filters.filter_scanlines) and compressed with
+    block-parallel deflate: filtered data is split into blocks, which are compressed by separate threads and
+    joined into a single zlib stream (the same way as pigz does it).
+
+    Args:
+        width(int): Image width
+        height(int): Image height
+        color_type(int): PNG color type (0, 2, 3, 4 or 6)
+        bit_depth(int): Number of bits per sample
+        filter_strategy: Filter type used for every scanline, filters.ADAPTIVE_FILTER_STRATEGY or filters.BRUTE_FORCE_FILTER_STRATEGY
+        compression_level(int): zlib compression level
+        compression_strategy(int): zlib strategy, e.g. zlib.Z_DEFAULT_STRATEGY or zlib.Z_FILTERED
+        mem_level(int): zlib memLevel (1-9)
+        workers(int): Number of compressing threads. Defaults to ThreadPoolExecutor default.
+        deflate_block_len(int): Amount of filtered data compressed by single thread. Defaults to DEFLATE_BLOCK_LEN.
+                                Every block adds a few bytes, so it can be increased to trade speed for size.
+    """
+    COLOR_TYPE_TO_SAMPLES_PER_PIXEL = {
+        0: 1,
+        2: 3,
+        3: 1,
+        4: 2,
+        6: 4
+    }
+    # Amount of filtered data compressed by single thread
+    DEFLATE_BLOCK_LEN = 2 ** 20
+    # Deflate can refer up to 32 KiB back, so every block is primed with the end of the previous one
+    DEFLATE_WINDOW_LEN = 2 ** 15
+    MAX_IDAT_DATA_LEN = 2 ** 20
+
+    def __init__(self, width, height, color_type, bit_depth=8, filter_strategy=ADAPTIVE_FILTER_STRATEGY,
+                    compression_level=6, compression_strategy=zlib.Z_DEFAULT_STRATEGY, mem_level=8, workers=None, deflate_block_len=None):
+        self.width = width
+        self.height = height
+        self.color_type = color_type
+        self.bit_depth = bit_depth
+        self.filter_strategy = filter_strategy
+        self.compression_level = compression_level
+        self.compression_strategy = compression_strategy
+        self.mem_level = mem_level
+        self.workers = workers
+        self.deflate_block_len = deflate_block_len or self.DEFLATE_BLOCK_LEN
+
+    def write(self, file_handler, pixels, extra_chunks=()):
+        """Write PNG file
+
+        Args:
+            file_handler: File opened in binary mode
+            pixels(np.ndarray): Array of shape (height, width, samples_per_pixel)
+            extra_chunks(iterable): Chunks written between IHDR and IDAT (e.g. PLTE)
+        """
+        log.debug('Encoding PNG')
+        file_handler.write(b'\x89PNG\r\n\x1a\n')
+        for chunk in self.create_chunks(pixels, extra_chunks):
+            chunk.write(file_handler)
+
+    def create_chunks(self, pixels, extra_chunks=()):
+        """Encode pixels and return all chunks of new PNG: IHDR, extra chunks, IDATs and IEND
+        """
+        samples_per_pixel = self.COLOR_TYPE_TO_SAMPLES_PER_PIXEL.get(self.color_type)
+        assert pixels.shape == (self.height, self.width, samples_per_pixel), (
+                            f"Pixels of shape {pixels.shape} do not match image of size {self.width}x{self.height} with {samples_per_pixel} samples per pixel")
+
+        ihdr_data = struct.pack('>iibbbbb', self.width, self.height, self.bit_depth, self.color_type, 0, 0, 0)
+        scanlines = pack_samples(pixels, self.bit_depth)
+        bytes_per_pixel = max(1, samples_per_pixel * self.bit_depth // 8)
+        compressed = self.compress(self.filter_images([(scanlines, bytes_per_pixel)]))
+
+        chunks = [create_chunk(b'IHDR', ihdr_data)]
+        chunks.extend(extra_chunks)
+        chunks.extend(create_chunk(b'IDAT', compressed[i : i + self.MAX_IDAT_DATA_LEN])
+                        for i in range(0, len(compressed), self.MAX_IDAT_DATA_LEN))
+        chunks.append(create_chunk(b'IEND', b''))
+        return chunks
+
+    def filter_images(self, images):
+        """Filter scanlines of one or more images (e.g. Adam7 passes) and join them into a single stream
+
+        Args:
+            images(list): (scanlines, bytes_per_pixel) pairs, where scanlines is uint8 array of shape (height, stride)
+
+        Returns:
+            np.ndarray: uint8 array with filtered scanlines of all images, ready to be compressed
+        """
+        filtered_images = []
+        for scanlines, bytes_per_pixel in images:
+            strategy = self.filter_strategy
+            if strategy == BRUTE_FORCE_FILTER_STRATEGY:
+                strategy = self.choose_filters_by_compression(scanlines, bytes_per_pixel)
+            filtered_images.append(filter_scanlines(scanlines, bytes_per_pixel, strategy).reshape(-1))
+        return np.concatenate(filtered_images)
+
+    def choose_filters_by_compression(self, scanlines, bytes_per_pixel):
+        """Choose filter of every scanline by compressing it with every filter type
+
+        Scanlines are fed to a single compressor. For every scanline, compressor state is copied for each filter type
+        and the filter which produces the least compressed bytes (taking all previous scanlines into account) wins.
+
+        Returns:
+            np.ndarray: Filter type of every scanline
+        """
+        candidates = [filter_all_scanlines(scanlines, bytes_per_pixel, filter_type) for filter_type in FILTER_TYPES]
+        chosen = np.empty(scanlines.shape[0], dtype=np.uint8)
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS, self.mem_level, self.compression_strategy)
+
+        for r in range(scanlines.shape[0]):
+            sizes = []
+            for filter_type in FILTER_TYPES:
+                trial = compressor.copy()
+                sizes.append(len(trial.compress(bytes([filter_type])) + trial.compress(candidates[filter_type][r]) + trial.flush(zlib.Z_SYNC_FLUSH)))
+            chosen[r] = FILTER_TYPES[sizes.index(min(sizes))]
+            compressor.compress(bytes([chosen[r]]))
+            compressor.compress(candidates[chosen[r]][r])
+
+        return chosen
+
+    def compress(self, filtered):
+        """Compress filtered scanlines to zlib stream, block by block in parallel threads
+
+        Every block is compressed as a raw deflate stream. All blocks except the last one end with sync flush,
+        so they are byte-aligned and can be simply concatenated. zlib header and Adler-32 checksum of the
+        whole data are added around them.
+
+        Args:
+            filtered(np.ndarray): Filtered scanlines
+
+        Returns:
+            bytes: zlib stream
+        """
+        data = memoryview(filtered).cast('B')
+        block_starts = range(0, len(data), self.deflate_block_len)
+
+        def compress_block(start):
+            dictionary = data[max(0, start - self.DEFLATE_WINDOW_LEN) : start]
+            if dictionary:
+                compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS, self.mem_level,
+                                                self.compression_strategy, dictionary)
+            else:
+                compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS, self.mem_level,
+                                                self.compression_strategy)
+            end = start + self.deflate_block_len
+            flush_mode = zlib.Z_FINISH if end >= len(data) else zlib.Z_SYNC_FLUSH
+            return compressor.compress(data[start:end]) + compressor.flush(flush_mode)
+
+        if len(block_starts) == 1 or self.workers == 1:
+            blocks = [compress_block(start) for start in block_starts]
+        else:
+            with ThreadPoolExecutor(self.workers) as executor:
+                blocks = list(executor.map(compress_block, block_starts))
+
+        return b''.join([self.get_zlib_header(), *blocks, zlib.adler32(data).to_bytes(4, 'big')])
+
+    def get_zlib_header(self):
+        """Create 2-byte zlib header (RFC 1950) for deflate stream with 32 KiB window
+        """
+        cmf = 0x78
+        if self.compression_level in (0, 1) or self.compression_strategy in (zlib.Z_HUFFMAN_ONLY, zlib.Z_RLE):
+            compression_level_flag = 0
+        elif 2 <= self.compression_level <= 5:
+            compression_level_flag = 1
+        elif self.compression_level in (6, zlib.Z_DEFAULT_COMPRESSION):
+            compression_level_flag = 2
+        else:
+            compression_level_flag = 3
+        flg = compression_level_flag << 6
+        # FCHECK bits make the header a multiple of 31
+        flg |= (31 - (cmf * 256 + flg) % 31) % 31
+        return bytes([cmf, flg])
@@ -0,0 +1,107 @@
+import logging
+import math
+from pngwriter import PngWriter
+from lazyimport import lazy_import
+
+np = lazy_import('numpy')
+
+log = logging.getLogger(__name__)
+
+def downscale(pixels, factor):
+    """Downscale image by integer factor using box (area) averaging
+
+    Image is padded (by repeating its last row and column) up to a multiple of factor, then every factor x factor
+    block is reshaped into its own axes and averaged - all blocks at once.
+
+    Args:
+        pixels(np.ndarray): Float array of shape (height, width, samples_per_pixel)
+        factor(int): Size of averaged block
+
+    Returns:
+        np.ndarray: Float array of shape (ceil(height / factor), ceil(width / factor), samples_per_pixel)
+    """
+    if factor == 1:
+        return pixels
+    height, width, samples_per_pixel = pixels.shape
+    pixels = np.pad(pixels, ((0, -height % factor), (0, -width % factor), (0, 0)), mode='edge')
+    blocks = pixels.reshape(pixels.shape[0] // factor, factor, pixels.shape[1] // factor, factor, samples_per_pixel)
+    return blocks.mean(axis=(1, 3))
+
+def get_background_color(png, background=None):
+    """Return background color as float array of RGB values in range 0-1
+
+    Args:
+        png(Png): Parsed PNG
+        background(str): Hex RGB color, e.g. 'ffffff'. If it is None, color stored in bKGD chunk is used or white, if there is no such chunk.
+    """
+    if background is not None:
+        background = str(background).lstrip('#').zfill(6)
+        return np.array([int(background[i : i + 2], 16) for i in (0, 2, 4)]) / 255
+
+    bkgd_chunk = png.get_chunk_by_type(b'bKGD')
+    if bkgd_chunk is None:
+        return np.ones(3)
+
+    ihdr_chunk = png.get_chunk_by_type(b'IHDR')
+    if ihdr_chunk.color_type == 3:
+        # Pallette index
+        return png.get_chunk_by_type(b'PLTE').get_pallette_array()[bkgd_chunk.data[0]] / 255
+    # One (greyscale) or three (RGB) 2-byte samples in image's bit depth
+    samples = np.frombuffer(bkgd_chunk.data, dtype='>u2') / (2 ** ihdr_chunk.bit_depth - 1)
+    return np.resize(samples, 3)
+
+def render(png, output_file, size=None, keep_alpha=False, background=None, compression_level=6):
+    """Write 8-bit preview of PNG to a new file using PngWriter
+
+    Args:
+        png(Png): Parsed PNG
+        output_file(str): Path of preview
+        size(int): Maximum width and height of preview. Image is downscaled by the smallest integer factor, which fits it in.
+                   If it is None, full-size preview is written.
+        keep_alpha(bool): If set to true, alpha channel is kept. Otherwise, image is composited over background.
+        background(str): Hex RGB color used for compositing - see get_background_color
+        compression_level(int): zlib compression level
+
+    Returns:
+        tuple: (width, height) of preview
+    """
+    ihdr_chunk = png.get_chunk_by_type(b'IHDR')
+    pixels = png.reconstructed_idat_data
+    samples_per_pixel = pixels.shape[2]
+    has_alpha = samples_per_pixel in (2, 4)
+
+    # Pallette is expanded to 8-bit RGB(A), other images keep theirs bit depth
+    max_value = 255 if ihdr_chunk.color_type == 3 else 2 ** ihdr_chunk.bit_depth - 1
+    pixels = pixels.astype(np.float32) / max_value
+
+    factor = max(1, math.ceil(max(pixels.shape[:2]) / size)) if size else 1
+    if has_alpha:
+        # Colors are premultiplied by alpha, so transparent pixels do not leak theirs colors into averaged blocks
+        color, alpha = pixels[:, :, :-1], pixels[:, :, -1:]
+        pixels = downscale(np.concatenate((color * alpha, alpha), axis=2), factor)
+        color, alpha = pixels[:, :, :-1], pixels[:, :, -1:]
+        if keep_alpha:
+            color = np.divide(color, alpha, out=np.zeros_like(color), where=alpha > 0)
+            pixels = np.concatenate((color, alpha), axis=2)
+        else:
+            background_color = get_background_color(png, background)
+            if color.shape[2] == 1:
+                # Greyscale image - background color is converted to grey just as in Png.get_grayscale_pixels
+                background_color = background_color[np.newaxis] @ np.array([0.299, 0.587, 0.114])
+            pixels = color + (1 - alpha) * background_color
+    else:
+        pixels = downscale(pixels, factor)
+
+    pixels = np.rint(np.clip(pixels, 0, 1) * 255).astype(np.uint8)
+    height, width, samples_per_pixel = pixels.shape
+    samples_per_pixel_to_color_type = {
+        1: 0, # greyscale
+        2: 4, # greyscale with alpha
+        3: 2, # truecolor
+        4: 6, # truecolor with alpha
+    }
+    log.info(f"Rendering {ihdr_chunk.width}x{ihdr_chunk.height} image to '{output_file}' ({width}x{height})")
+    png_writer = PngWriter(width, height, samples_per_pixel_to_color_type[samples_per_pixel], compression_level=compression_level)
+    with open(output_file, 'wb') as f:
+        png_writer.write(f, pixels)
+    return width, height
@@ -1,27 +1,35 @@
+from blockcodec import BlockCodec
+from blockengine import BlockEngine, rsa_pow
 from keygenerator import KeyGenerator
-from collections import deque
+from keystore import KeyStore
 from pngImage import Png
+from pngwriter import PngWriter
 import logging
 import random
-from Cryptodome.Cipher import PKCS1_OAEP
-from Cryptodome import Random
-from Cryptodome.PublicKey import RSA
-import Cryptodome as crypto
+from lazyimport import lazy_import
 
 log = logging.getLogger(__name__)
 
-try:
-    import png
-except ModuleNotFoundError:
-    traceback.print_exc()
-    print("\033[1;33mBefore you will debug, please delete 'venv' dir from project root and try again.\033[0m")
-    exit(1)
+np = lazy_import('numpy')
+PKCS1_OAEP = lazy_import('Cryptodome.Cipher.PKCS1_OAEP')
+RSA = lazy_import('Cryptodome.PublicKey.RSA')
 
 class _RSA:
-    def __init__(self, key_size):
+    def __init__(self, key_size, workers=None, use_crt=True, public_exponent=None, key=None, keystore=None):
         log.info("Initializing RSA module")
-        self.public_key, self.private_key = KeyGenerator(key_size).generateKeys()
+        if key is not None:
+            # Key pair generated earlier (e.g. by keygen command) - its size overrides key_size
+            self.public_key, self.private_key = (keystore or KeyStore()).load(key)
+            key_size = self.public_key[1].bit_length()
+            log.info(f"Using {key_size} bit key '{key}'")
+        else:
+            # Primes are searched by the same number of processes as ECB blocks are processed
+            self.public_key, self.private_key = KeyGenerator(key_size, public_exponent, workers).generateKeys()
         self.key_size = key_size
+        # Private key contains CRT parameters, so decryption can use two half-size exponentiations instead of one full-size
+        self.decryption_key = self.private_key if use_crt else self.private_key[:2]
+        # ECB blocks are independent, so they are encrypted and decrypted by a process pool
+        self.block_engine = BlockEngine(workers)
 
         # chunk that goes to encryption should be a bit smaller than key length in order for RSA to work properly => math stuff
         self.amount_of_bytes_to_substract_from_chunk_size = 1
@@ -32,91 +40,65 @@ class _RSA:
         self.encrypted_chunk_size_in_bytes = key_size // 8
         self.encrypted_chunk_size_in_bytes2 = key_size // 16
 
+        # Layout of encrypted blocks in encrypted PNG - see BlockCodec
+        self.block_codec = BlockCodec(self.encrypted_chunk_size_in_bytes, self.encrypted_chunk_size_in_bytes_substracted)
+        # Crypto package blocks have key length too, but only their first half goes to cipher data
+        self.block_codec2 = BlockCodec(self.encrypted_chunk_size_in_bytes, self.encrypted_chunk_size_in_bytes_substracted2)
+
     def ECB_encrypt(self, data):
+        # Pixel buffer is read through a flat byte view, so it is not copied
+        data = memoryview(data).cast('B')
         log.info(f"Performing ECB RSA encryption using {self.key_size} bit public key")
 
-        cipher_data = []
-        after_iend_data_embedded = []
         self.original_data_len = len(data)
 
-        for i in range(0, len(data), self.encrypted_chunk_size_in_bytes_substracted):
-            chunk_to_encrypt_hex = bytes(data[i: i + self.encrypted_chunk_size_in_bytes_substracted])
-
-            cipher_int = pow(int.from_bytes(chunk_to_encrypt_hex, 'big'), self.public_key[0], self.public_key[1])
+        cipher = self.block_engine.pow(data, self.encrypted_chunk_size_in_bytes_substracted, self.encrypted_chunk_size_in_bytes,
+                                        self.public_key)
 
-            cipher_hex = cipher_int.to_bytes(self.encrypted_chunk_size_in_bytes, 'big')
-
-            for i in range(self.encrypted_chunk_size_in_bytes_substracted):
-                cipher_data.append(cipher_hex[i])
-            after_iend_data_embedded.append(cipher_hex[-1])
-        cipher_data.append(after_iend_data_embedded.pop())
-
-        return cipher_data, after_iend_data_embedded
+        return self.block_codec.split(cipher)
 
     def ECB_decrypt(self, data, after_iend_data):
         log.info(f"Performing ECB RSA decryption using {self.key_size} bit private key")
 
-        data_to_decrypt = self.concentate_data_to_decrypt(data, deque(after_iend_data))
-        decrypted_data = []
+        data_to_decrypt = self.concentate_data_to_decrypt(data, after_iend_data)
 
-        for i in range(0, len(data_to_decrypt), self.encrypted_chunk_size_in_bytes):
-            chunk_to_decrypt_hex = bytes(data_to_decrypt[i: i + self.encrypted_chunk_size_in_bytes])
+        # Chunks after encryption have fixed key-length size, so we don't know how long was the last original chunk.
+        # Every other chunk had encryption_RSA_chunk length, so the length of the last one is what remains of original_data_len
+        blocks_number = -(-len(data_to_decrypt) // self.encrypted_chunk_size_in_bytes)
+        last_decrypted_hex_len = self.original_data_len - (blocks_number - 1) * self.encrypted_chunk_size_in_bytes_substracted
 
-            decrypted_int = pow(int.from_bytes(chunk_to_decrypt_hex, 'big'), self.private_key[0], self.private_key[1])
-
-            # We don't know how long was the last original chunk (no matter what, chunks after encryption have fixd key-length size, so extra bytes could have been added), 
-            # so below, before creating decrpyted_hex of fixed size we check if adding it to decrpted_data wouldn't exceed the original_data_len
-            # If it does, we know that the length of last chunk was smaller and we can retrieve it's length
-            if len(decrypted_data) + self.encrypted_chunk_size_in_bytes_substracted > self.original_data_len:
-                # last original chunk
-                decrypted_hex_len = self.original_data_len - len(decrypted_data)
-            else:
-                # standard encryption_RSA_chunk length
-                decrypted_hex_len = self.encrypted_chunk_size_in_bytes_substracted
-
-            decrypted_hex = decrypted_int.to_bytes(decrypted_hex_len, 'big')
-
-            for byte in decrypted_hex:
-                decrypted_data.append(byte)
-
-        return decrypted_data
+        return self.block_engine.pow(data_to_decrypt, self.encrypted_chunk_size_in_bytes, self.encrypted_chunk_size_in_bytes_substracted,
+                                        self.decryption_key, last_decrypted_hex_len)
 
     def create_decrypted_png(self, decrpted_data, bytes_per_pixel, width, height, decrypted_png_path):
         log.info(f"Creating decrypted file '{decrypted_png_path}'")
 
         png_writer = self.get_png_writer(width, height, bytes_per_pixel)
-        bytes_row_width = width * bytes_per_pixel
-        pixels_grouped_by_rows = [decrpted_data[i: i + bytes_row_width] for i in range(0, len(decrpted_data), bytes_row_width)]
+        pixels = np.frombuffer(decrpted_data, dtype=np.uint8).reshape(height, width, bytes_per_pixel)
 
-        f = open(decrypted_png_path, 'wb')
-        png_writer.write(f, pixels_grouped_by_rows)
-        f.close()
+        with open(decrypted_png_path, 'wb') as f:
+            png_writer.write(f, pixels)
 
     def create_encrypted_png(self, cipher_data, bytes_per_pixel, width, height, encrypted_png_path, after_iend_data_embedded):
         log.info(f"Creating encrpyted file '{encrypted_png_path}'")
 
         idat_data, after_iend_data = self.extract_after_iend_pixels(cipher_data)
         png_writer = self.get_png_writer(width, height, bytes_per_pixel)
-        bytes_row_width = width * bytes_per_pixel
-        pixels_grouped_by_rows = [idat_data[i: i + bytes_row_width] for i in range(0, len(idat_data), bytes_row_width)]
+        pixels = np.frombuffer(idat_data, dtype=np.uint8).reshape(height, width, bytes_per_pixel)
 
-        f = open(encrypted_png_path, 'wb')
-        png_writer.write(f, pixels_grouped_by_rows)
-        f.write(bytes(after_iend_data_embedded))
-        f.write(bytes(after_iend_data))
-        f.close()
+        with open(encrypted_png_path, 'wb') as f:
+            png_writer.write(f, pixels)
+            f.write(after_iend_data_embedded)
+            f.write(after_iend_data)
 
     def get_png_writer(self, width, height, bytes_per_pixel):
-        if bytes_per_pixel == 1:
-            png_writer = png.Writer(width, height, greyscale=True)
-        elif bytes_per_pixel == 2:
-            png_writer = png.Writer(width, height, greyscale=True, alpha=True)
-        elif bytes_per_pixel == 3:
-            png_writer = png.Writer(width, height, greyscale=False)
-        elif bytes_per_pixel == 4:
-            png_writer = png.Writer(width, height, greyscale=False, alpha=True)
-
-        return png_writer
+        bytes_per_pixel_to_color_type = {
+            1: 0, # greyscale
+            2: 4, # greyscale with alpha
+            3: 2, # truecolor
+            4: 6, # truecolor with alpha
+        }
+        return PngWriter(width, height, bytes_per_pixel_to_color_type.get(bytes_per_pixel))
 
     def extract_after_iend_pixels(self, cipher_data):
         """
@@ -125,37 +107,24 @@ class _RSA:
         The hack is to put new pixels after IEND chunk, so image can be displayed properly AND
         further deciphering operation can be successfull.
         """
-        cipher_data = deque(cipher_data)
-        idat_data = []
-        after_iend_data = []
-        for i in range(self.original_data_len):
-            idat_data.append(cipher_data.popleft())
-        for i in range(len(cipher_data)):
-            after_iend_data.append(cipher_data.popleft())
-        
-        return idat_data, after_iend_data
-
-    def concentate_data_to_decrypt(self, data, after_iend_data: deque):
-        data_to_decrypt = []
+        # Both parts are views of cipher data, nothing is copied
+        cipher_data = memoryview(cipher_data).cast('B')
+        return cipher_data[:self.original_data_len], cipher_data[self.original_data_len:]
 
-        for i in range(0, len(data), self.encrypted_chunk_size_in_bytes_substracted):
-            data_to_decrypt.extend(data[i:i + self.encrypted_chunk_size_in_bytes_substracted])
-            data_to_decrypt.append(after_iend_data.popleft())
-        data_to_decrypt.extend(after_iend_data)
-
-        return data_to_decrypt
+    def concentate_data_to_decrypt(self, data, after_iend_data):
+        return self.block_codec.join(data, after_iend_data)
 
     def CBC_encrypt(self, data):
+        data = memoryview(data).cast('B')
         log.info(f"Performing CBC RSA encryption using {self.key_size} bit public key")
 
-        cipher_data = []
-        decrypted_data = []
-        after_iend_data_embedded = []
         self.original_data_len = len(data)
         self.IV = random.getrandbits(self.key_size)
         prev = self.IV
+        blocks_number = -(-len(data) // self.encrypted_chunk_size_in_bytes_substracted)
+        cipher = bytearray(blocks_number * self.encrypted_chunk_size_in_bytes)
 
-        for i in range(0, len(data), self.encrypted_chunk_size_in_bytes_substracted):
+        for block, i in enumerate(range(0, len(data), self.encrypted_chunk_size_in_bytes_substracted)):
             chunk_to_encrypt_hex = bytes(data[i: i + self.encrypted_chunk_size_in_bytes_substracted])
 
             prev = prev.to_bytes(self.encrypted_chunk_size_in_bytes, 'big')
@@ -166,32 +135,29 @@ class _RSA:
             prev = cipher_int
 
             cipher_hex = cipher_int.to_bytes(self.encrypted_chunk_size_in_bytes, 'big')
+            cipher[block * self.encrypted_chunk_size_in_bytes : (block + 1) * self.encrypted_chunk_size_in_bytes] = cipher_hex
 
-            for i in range(self.encrypted_chunk_size_in_bytes_substracted):
-                cipher_data.append(cipher_hex[i])
-            after_iend_data_embedded.append(cipher_hex[-1])
-        cipher_data.append(after_iend_data_embedded.pop())
-
-        return cipher_data, after_iend_data_embedded
+        return self.block_codec.split(cipher)
 
     def CBC_decrypt(self, data, after_iend_data):
         log.info(f"Performing CBC RSA decryption using {self.key_size} bit private key")
 
-        data_to_decrypt = self.concentate_data_to_decrypt(data, deque(after_iend_data))
-        decrypted_data = []
+        data_to_decrypt = self.concentate_data_to_decrypt(data, after_iend_data)
+        decrypted_data = bytearray(self.original_data_len)
+        decrypted_data_len = 0
         prev = self.IV
 
         for i in range(0, len(data_to_decrypt), self.encrypted_chunk_size_in_bytes):
             chunk_to_decrypt_hex = bytes(data_to_decrypt[i: i + self.encrypted_chunk_size_in_bytes])
 
-            decrypted_int = pow(int.from_bytes(chunk_to_decrypt_hex, 'big'), self.private_key[0], self.private_key[1])
+            decrypted_int = rsa_pow(int.from_bytes(chunk_to_decrypt_hex, 'big'), self.decryption_key)
 
             # We don't know how long was the last original chunk (no matter what, chunks after encryption have fixd key-length size, so extra bytes could have been added),
             # so below, before creating decrpyted_hex of fixed size we check if adding it to decrpted_data wouldn't exceed the original_data_len
             # If it does, we know that the length of last chunk was smaller and we can retrieve it's length
-            if len(decrypted_data) + self.encrypted_chunk_size_in_bytes_substracted > self.original_data_len:
+            if decrypted_data_len + self.encrypted_chunk_size_in_bytes_substracted > self.original_data_len:
                 # last original chunk
-                decrypted_hex_len = self.original_data_len - len(decrypted_data)
+                decrypted_hex_len = self.original_data_len - decrypted_data_len
             else:
                 # standard encryption_RSA_chunk length
                 decrypted_hex_len = self.encrypted_chunk_size_in_bytes_substracted
@@ -202,29 +168,25 @@ class _RSA:
             prev = int.from_bytes(chunk_to_decrypt_hex, 'big')
 
             decrypted_hex = xor.to_bytes(decrypted_hex_len, 'big')
-
-            for byte in decrypted_hex:
-                decrypted_data.append(byte)
+            decrypted_data[decrypted_data_len : decrypted_data_len + decrypted_hex_len] = decrypted_hex
+            decrypted_data_len += decrypted_hex_len
 
         return decrypted_data
 
     def Crypto_encrypt(self, data):
+        data = memoryview(data).cast('B')
         log.info(f"Performing Crypto Package RSA encryption using {self.key_size} bit public key")
 
-        cipher_data = []
-        after_iend_data_embedded = []
         self.original_data_len = len(data)
         key = RSA.construct((self.public_key[1] , self.public_key[0]))
-        cipher = PKCS1_OAEP.new(key)    
+        cipher = PKCS1_OAEP.new(key)
+        blocks_number = -(-len(data) // self.encrypted_chunk_size_in_bytes_substracted2)
+        encrypted_blocks = bytearray(blocks_number * self.encrypted_chunk_size_in_bytes)
 
-        for i in range(0, len(data), self.encrypted_chunk_size_in_bytes_substracted2):
+        for block, i in enumerate(range(0, len(data), self.encrypted_chunk_size_in_bytes_substracted2)):
             chunk_to_encrypt_hex = bytes(data[i: i + self.encrypted_chunk_size_in_bytes_substracted2])
             cipher_hex = cipher.encrypt(chunk_to_encrypt_hex)
-            
-            for i in range(self.encrypted_chunk_size_in_bytes_substracted2):
-                cipher_data.append(cipher_hex[i])
-            after_iend_data_embedded.append(cipher_hex[-1])
-        cipher_data.append(after_iend_data_embedded.pop())
+            encrypted_blocks[block * self.encrypted_chunk_size_in_bytes : (block + 1) * self.encrypted_chunk_size_in_bytes] = cipher_hex
 
-        return cipher_data, after_iend_data_embedded
+        return self.block_codec2.split(encrypted_blocks)
 
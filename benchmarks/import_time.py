@@ -0,0 +1,72 @@
+"""Import-time benchmark of CLI cold startup
+
+Runs 'cli.py metadata' with 'python -X importtime' several times and sums times of all top-level imports.
+It fails (exit code 1) if the fastest run exceeds the budget or if any of heavy packages, which metadata
+command does not need, is imported.
+
+Usage:
+    python benchmarks/import_time.py [--budget-ms 220] [--runs 5] [--file-name png_files/dice.png]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_ENTRYPOINT = os.path.join(ROOT_DIR, 'app', 'cli.py')
+
+# Packages that must not be imported by metadata command
+FORBIDDEN_MODULES = ('numpy', 'matplotlib', 'Cryptodome', 'cv2', 'png')
+
+def measure_import_time(command):
+    """Run command with -X importtime
+
+    Returns:
+        tuple: (total_import_time_us, dict with cumulative time of every top-level import, set of all imported modules)
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', CLI_ENTRYPOINT, *command],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    top_level_imports = {}
+    all_imports = set()
+    for line in completed.stderr.splitlines():
+        # Line format: 'import time: self [us] | cumulative | imported package', nested imports are indented
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        # Nested imports count too - heavy package imported by any app module is as slow as the one imported by cli.py
+        all_imports.add(name.strip())
+        if not name.startswith('  '):
+            top_level_imports[name.strip()] = int(cumulative)
+    return sum(top_level_imports.values()), top_level_imports, all_imports
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=220, help='Maximum total import time of metadata command')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs, the fastest one is compared with budget')
+    parser.add_argument('--file-name', default=os.path.join(ROOT_DIR, 'png_files', 'dice.png'))
+    args = parser.parse_args()
+
+    runs = [measure_import_time(['--file-name', args.file_name, 'metadata']) for _ in range(args.runs)]
+    total_us, top_level_imports, all_imports = min(runs, key=lambda run: run[0])
+
+    print("Slowest top-level imports:")
+    for name, cumulative_us in sorted(top_level_imports.items(), key=lambda item: item[1], reverse=True)[:10]:
+        print(f"  {name:<30} {cumulative_us / 1000:8.1f} ms")
+    print(f"Total import time of metadata command: {total_us / 1000:.1f} ms (budget: {args.budget_ms:.1f} ms)")
+
+    failed = False
+    forbidden = sorted({name.split('.')[0] for name in all_imports} & set(FORBIDDEN_MODULES))
+    if forbidden:
+        print(f"FAIL: metadata command imports {forbidden}")
+        failed = True
+    if total_us / 1000 > args.budget_ms:
+        print("FAIL: import time budget exceeded")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+if __name__ == '__main__':
+    main()
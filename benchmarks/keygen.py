@@ -0,0 +1,69 @@
+"""RSA key generation benchmark
+
+For every key size, public exponent (random full-size e or fixed 65537) and number of prime search processes,
+several key pairs are generated. Median and maximum times are printed and every key pair is checked by encrypting
+and decrypting (with CRT) a random number. Every key pair is also saved to a temporary keystore and loaded back -
+median load time shows what rsa command pays with --key instead of generating a new key pair.
+
+Usage:
+    python benchmarks/keygen.py [--key-sizes 1024 2048 4096] [--repeats 5] [--workers 1 4]
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'app'))
+
+from blockengine import rsa_pow
+from keygenerator import DEFAULT_PUBLIC_EXPONENT, KeyGenerator
+from keystore import KeyStore
+
+def is_valid(public_key, private_key):
+    e, n = public_key
+    value = random.randrange(2, n)
+    return rsa_pow(rsa_pow(value, public_key), private_key) == value == pow(pow(value, e, n), private_key[0], n)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--key-sizes', type=int, nargs='+', default=[1024, 2048, 4096])
+    parser.add_argument('--repeats', type=int, default=5, help='Number of key pairs generated for every configuration')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1], help='Numbers of prime search processes')
+    args = parser.parse_args()
+
+    keystore = KeyStore(tempfile.mkdtemp())
+    failed = False
+    print(f"{'Key':>5} | {'e':>6} | {'Workers':>7} | {'Median [s]':>10} | {'Max [s]':>8} | {'Load [ms]':>9}")
+    for key_size in args.key_sizes:
+        for public_exponent in (None, DEFAULT_PUBLIC_EXPONENT):
+            for workers in sorted(set(args.workers)):
+                times = []
+                load_times = []
+                for _ in range(args.repeats):
+                    start_time = time.perf_counter()
+                    public_key, private_key = KeyGenerator(key_size, public_exponent, workers).generateKeys()
+                    times.append(time.perf_counter() - start_time)
+
+                    keystore.save(public_key, private_key, 'benchmark')
+                    start_time = time.perf_counter()
+                    loaded_key_pair = keystore.load('benchmark')
+                    load_times.append(time.perf_counter() - start_time)
+
+                    if not is_valid(public_key, private_key) or loaded_key_pair != (public_key, private_key):
+                        print(f"FAIL: invalid {key_size} bit key pair")
+                        failed = True
+                e = public_exponent or 'random'
+                print(f"{key_size:>5} | {e:>6} | {workers:>7} | {statistics.median(times):>10.3f} | {max(times):>8.3f} | "
+                      f"{statistics.median(load_times) * 1000:>9.2f}")
+
+    shutil.rmtree(keystore.directory)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
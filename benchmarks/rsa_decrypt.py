@@ -0,0 +1,73 @@
+"""RSA decryption benchmark: full-size exponentiation vs Chinese Remainder Theorem
+
+For every key size a key pair is generated, then the beginning of pixel data of every sample image is
+encrypted in ECB mode and decrypted twice - with pow(c, d, n) and with CRT (see blockengine.rsa_pow).
+Both decrypted buffers are compared with original data.
+
+Usage:
+    python benchmarks/rsa_decrypt.py [--key-sizes 1024 2048 4096] [--max-bytes 16384] [--workers 1]
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'app'))
+
+from pngImage import Png
+from rsa import _RSA
+
+def measure(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--key-sizes', type=int, nargs='+', default=[1024, 2048, 4096])
+    parser.add_argument('--max-bytes', type=int, default=2 ** 14, help='Number of pixel bytes taken from every image')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes of block engine')
+    parser.add_argument('--files', nargs='+', default=sorted(glob.glob(os.path.join(ROOT_DIR, 'png_files', '*.png'))))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    images = []
+    for file_name in args.files:
+        png = Png(file_name)
+        png.parse(True)
+        # Data is taken from the middle of image - borders are often fully transparent (zeros), which are trivial to exponentiate
+        pixels = memoryview(png.reconstructed_idat_data).cast('B')
+        start = max(0, (len(pixels) - args.max_bytes) // 2)
+        images.append((os.path.basename(file_name), bytes(pixels[start : start + args.max_bytes])))
+
+    failed = False
+    print(f"{'Key':>5} | {'Image':<12} | {'Blocks':>6} | {'pow(c, d, n) [s]':>16} | {'CRT [s]':>8} | {'Speedup':>7}")
+    for key_size in args.key_sizes:
+        rsa, keygen_time = measure(_RSA, key_size, args.workers)
+        print(f"{key_size:>5} | key generation: {keygen_time:.2f} s")
+        full_key, crt_key = rsa.private_key[:2], rsa.private_key
+
+        for name, data in images:
+            cipher_data, after_iend_data_embedded = rsa.ECB_encrypt(data)
+            idat_data, after_iend_data = rsa.extract_after_iend_pixels(cipher_data)
+            after_iend_data = bytes(after_iend_data_embedded) + bytes(after_iend_data)
+            blocks = len(after_iend_data) + 1
+
+            rsa.decryption_key = full_key
+            full_decrypted, full_time = measure(rsa.ECB_decrypt, bytes(idat_data), after_iend_data)
+            rsa.decryption_key = crt_key
+            crt_decrypted, crt_time = measure(rsa.ECB_decrypt, bytes(idat_data), after_iend_data)
+
+            if bytes(full_decrypted) != data or bytes(crt_decrypted) != data:
+                print(f"FAIL: {name} was not decrypted correctly with {key_size} bit key")
+                failed = True
+            print(f"{key_size:>5} | {name:<12} | {blocks:>6} | {full_time:>16.3f} | {crt_time:>8.3f} | {full_time / crt_time:>6.2f}x")
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
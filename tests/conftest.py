@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules of app are imported by their names, just as cli.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
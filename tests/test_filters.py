@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from filters import FILTER_NONE, FILTER_PAETH, FILTER_TYPES, iter_defilter
+from pngparser import PngParser
+
+WIDTH = 19
+
+def make_idat_data(rng, filter_types, stride):
+    """Return decompressed IDAT data with scanlines of random bytes, filtered with given filter types
+    """
+    rows = []
+    for filter_type in filter_types:
+        rows.append(bytes([filter_type]) + rng.integers(0, 256, stride, dtype=np.uint8).tobytes())
+    return b''.join(rows)
+
+def split_randomly(rng, data):
+    """Split data into pieces of random length, as decompressor does
+    """
+    pieces = []
+    position = 0
+    while position < len(data):
+        length = int(rng.integers(1, 3 * WIDTH))
+        pieces.append(data[position : position + length])
+        position += length
+    return pieces
+
+def assert_same_as_reference(rng, idat_data, height, stride, bytes_per_pixel):
+    reconstructed = np.concatenate(list(iter_defilter(split_randomly(rng, idat_data), height, stride, bytes_per_pixel)))
+    reference = PngParser.reference_defilter(idat_data, height, stride, bytes_per_pixel)
+    assert reconstructed.tolist() == reference
+
+@pytest.mark.parametrize('bytes_per_pixel', [1, 2, 3, 4, 6, 8])
+@pytest.mark.parametrize('filter_type', FILTER_TYPES)
+def test_single_filter_type(filter_type, bytes_per_pixel):
+    rng = np.random.default_rng(filter_type * 10 + bytes_per_pixel)
+    stride = WIDTH * bytes_per_pixel
+    # The first scanline has zero prior row (Paeth fast path), the other ones have random prior rows
+    filter_types = [filter_type] * 8
+    assert_same_as_reference(rng, make_idat_data(rng, filter_types, stride), len(filter_types), stride, bytes_per_pixel)
+
+@pytest.mark.parametrize('bytes_per_pixel', [1, 2, 3, 4, 6, 8])
+def test_mixed_filter_types(bytes_per_pixel):
+    rng = np.random.default_rng(bytes_per_pixel)
+    stride = WIDTH * bytes_per_pixel
+    filter_types = rng.integers(0, len(FILTER_TYPES), 40).tolist()
+    assert_same_as_reference(rng, make_idat_data(rng, filter_types, stride), len(filter_types), stride, bytes_per_pixel)
+
+@pytest.mark.parametrize('bytes_per_pixel', [1, 2, 3, 4, 6, 8])
+def test_paeth_after_zero_row(bytes_per_pixel):
+    rng = np.random.default_rng(100 + bytes_per_pixel)
+    stride = WIDTH * bytes_per_pixel
+    # Scanline of zeros filtered with None is reconstructed to zeros, so the next Paeth scanline has zero prior row too
+    zero_row = bytes([FILTER_NONE]) + bytes(stride)
+    idat_data = (make_idat_data(rng, [FILTER_PAETH], stride) + zero_row + make_idat_data(rng, [FILTER_PAETH] * 2, stride)
+                    + zero_row + make_idat_data(rng, [FILTER_PAETH], stride))
+    assert_same_as_reference(rng, idat_data, 6, stride, bytes_per_pixel)
+
+def test_paeth_with_extreme_bytes():
+    # Differences a - c and b - c reach both ends of their range (-255 and 255)
+    rng = np.random.default_rng(0)
+    bytes_per_pixel = 3
+    stride = WIDTH * bytes_per_pixel
+    rows = [bytes([FILTER_PAETH]) + rng.choice(np.array([0, 255], dtype=np.uint8), stride).tobytes() for _ in range(30)]
+    assert_same_as_reference(rng, b''.join(rows), len(rows), stride, bytes_per_pixel)
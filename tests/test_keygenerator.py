@@ -0,0 +1,31 @@
+import pytest
+
+from blockengine import rsa_pow
+from keygenerator import DEFAULT_PUBLIC_EXPONENT, MIN_KEY_SIZE, KeyGenerator
+
+def assert_valid_key_pair(public_key, private_key, key_size):
+    e, n = public_key
+    assert n.bit_length() == key_size
+    for value in (0, 1, 2, n // 3, n - 1):
+        assert rsa_pow(rsa_pow(value, public_key), private_key) == value
+        assert pow(pow(value, e, n), private_key[0], n) == value
+
+@pytest.mark.parametrize('key_size', [17, 33, 1025])
+def test_odd_key_size_is_rejected(key_size):
+    with pytest.raises(ValueError):
+        KeyGenerator(key_size)
+
+@pytest.mark.parametrize('key_size', [2, 8, MIN_KEY_SIZE - 2])
+def test_too_small_key_size_is_rejected(key_size):
+    with pytest.raises(ValueError):
+        KeyGenerator(key_size)
+
+@pytest.mark.parametrize('key_size', [MIN_KEY_SIZE, 24, 64, 512])
+@pytest.mark.parametrize('public_exponent', [None, DEFAULT_PUBLIC_EXPONENT])
+def test_generated_key_pair_is_valid(key_size, public_exponent):
+    public_key, private_key = KeyGenerator(key_size, public_exponent).generateKeys()
+    assert_valid_key_pair(public_key, private_key, key_size)
+
+def test_parallel_search_generates_valid_key_pair():
+    public_key, private_key = KeyGenerator(256, DEFAULT_PUBLIC_EXPONENT, workers=2).generateKeys()
+    assert_valid_key_pair(public_key, private_key, 256)